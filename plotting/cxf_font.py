@@ -1,5 +1,6 @@
 from math import *
 import os
+import numpy as np
 import re
 import glob
 
@@ -78,6 +79,92 @@ def parse_cxf_font(filename):
                 stroke_list.append(segment_list)
     return font
 
+
+#=======================================================================
+# Same as above, but arcs are kept as arcs so they can be tessellated
+# once the size they'll be drawn at is known. Every command becomes a
+# one-piece stroke; a piece is a row of
+#   [LINE, x0, y0, x1, y1, 0]  or  [ARC, cx, cy, radius, start, end]
+# with arc angles in radians, counterclockwise from start to end.
+#=======================================================================
+LINE, ARC = 0.0, 1.0
+
+def parse_cxf_pieces(filename):
+    font = {}
+    key = None
+    stroke_list = []
+    with open(filename, 'r', encoding='ascii') as file:
+        for text in file:
+            if not text.strip():
+                if key is not None:
+                    font[key] = stroke_list
+                key = None
+                continue
+
+            new_cmd = re.match(r'^\[(.*)\]\s(\d+)', text)
+            if new_cmd:
+                key = new_cmd.group(1)
+                stroke_list = []
+            elif text.startswith('L '):
+                x0, y0, x1, y1 = [float(n) for n in text[2:].split(',')]
+                stroke_list.append(np.array([[LINE, x0, y0, x1, y1, 0.0]]))
+            elif text.startswith('A '):
+                xcenter, ycenter, radius, start_angle, end_angle = [float(n) for n in text[2:].split(',')]
+                if end_angle < start_angle:
+                    start_angle -= 360.0
+                stroke_list.append(np.array([[ARC, xcenter, ycenter, radius, radians(start_angle), radians(end_angle)]]))
+    if key is not None:
+        font[key] = stroke_list
+    return font
+
+def reverse_pieces(pieces):
+    """The same stroke drawn from the other end."""
+    reversed_pieces = pieces[::-1].copy()
+    lines = reversed_pieces[:, 0] == LINE
+    reversed_pieces[lines, 1:5] = reversed_pieces[lines][:, [3, 4, 1, 2]]
+    reversed_pieces[~lines, 4:6] = reversed_pieces[~lines][:, [5, 4]]
+    return reversed_pieces
+
+def piece_ends(pieces):
+    """First and last point of a stroke."""
+    def end(piece, which):
+        if piece[0] == LINE:
+            return (piece[1], piece[2]) if which == 0 else (piece[3], piece[4])
+        angle = piece[4] if which == 0 else piece[5]
+        return (piece[1] + cos(angle) * piece[3], piece[2] + sin(angle) * piece[3])
+    return end(pieces[0], 0), end(pieces[-1], 1)
+
+def arc_segments(pieces, max_angle=None):
+    """
+    How many segments each piece is drawn with: lines take one; arcs take
+    enough that no step is wider than `max_angle` (radians, scalar or per
+    piece). Without `max_angle`, arcs get the historical step of one
+    segment per 20 degrees started.
+    """
+    sweep = np.abs(pieces[:, 5] - pieces[:, 4])
+    if max_angle is None:
+        segments = np.floor(sweep / radians(20)) + 1
+    else:
+        segments = np.maximum(np.ceil(sweep / max_angle - 1e-9), 1)
+    return np.where(pieces[:, 0] == ARC, segments, 1).astype(np.int64)
+
+def tessellate(pieces, segments):
+    """Vertices of a stroke, with `segments[i]` segments for piece i."""
+    counts = segments + 1
+    piece = np.repeat(np.arange(len(pieces)), counts)
+    step = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    t = step / segments[piece]
+    rows = pieces[piece]
+
+    arcs = rows[:, 0] == ARC
+    angle = rows[:, 4] + (rows[:, 5] - rows[:, 4]) * t
+    x = np.where(arcs, rows[:, 1] + np.cos(angle) * rows[:, 3], rows[:, 1] + (rows[:, 3] - rows[:, 1]) * t)
+    y = np.where(arcs, rows[:, 2] + np.sin(angle) * rows[:, 3], rows[:, 2] + (rows[:, 4] - rows[:, 2]) * t)
+    # each piece after the first starts where the previous one ended
+    keep = (step > 0) | (piece == 0)
+    return np.column_stack((x[keep], y[keep]))
+
+
 f = None
 
 if __name__ == '__main__':
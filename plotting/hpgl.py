@@ -3,17 +3,47 @@ Designed to handle CLO3D-specific HPGL outputs.
 """
 
 from itertools import chain
-from functools import reduce
-import subprocess, io
+from collections import defaultdict
+from functools import reduce, partial
+import subprocess, io, re, os, shutil, tempfile
 
-from PIL import Image, ImagePalette
+from PIL import Image, ImageDraw, ImagePalette
+import numpy as np
 import shapely, shapely.geometry, shapely.ops
 import random, math
 from shapely.geometry import Point
 from typing import *
+import hpgl_profile
 
 Coord = Tuple[float, float]
 
+COORDINATE_COMMANDS = ('PU', 'PD', 'PA', 'DI', 'SI')
+DEFAULT_LABEL_TERMINATOR = '\x03'
+READ_CHUNK_SIZE = 1 << 16
+
+# wire formats for `Block.encode`: `verbatim` is `str(block)`; `compact`
+# rounds pen moves to whole plotter units and merges PU/PD runs; `pe` also
+# packs them into HPGL/2 `PE` polylines.
+ENCODINGS = ('verbatim', 'compact', 'pe')
+
+# matches coordinate tails that `format_coord_values` reproduces exactly
+_INTEGER_TAIL = re.compile(r'(?:0|-?[1-9][0-9]*)(?:,(?:0|-?[1-9][0-9]*))*')
+
+# marks a coordinate statement rewritten through `Statement.set_args`, which
+# serializes every value as a float.
+_FLOAT_TAIL = object()
+
+# counts lookups of memoized block geometry and plot extents
+geometry_cache_stats = {'hits': 0, 'misses': 0}
+
+# bumped whenever the trace of a block that has been measured changes, so
+# plot-level caches can tell they're stale
+_geometry_generation = 0
+
+def reset_geometry_cache_stats():
+    geometry_cache_stats['hits'] = 0
+    geometry_cache_stats['misses'] = 0
+
 def dist(a, b):
     return math.sqrt((a[0] - b[0])**2 + (a[1] - b[1])**2)
 
@@ -57,6 +87,8 @@ def reduce_coords(f, coords, start):
     return (reduce_coord(f, coords, start, 0), reduce_coord(f, coords, start, 1))
 
 def flatten_coords(coords):
+    if isinstance(coords, np.ndarray):
+        return coords.ravel().tolist()
     retval = []
     for x, y in coords:
         retval.append(x)
@@ -71,9 +103,164 @@ def coord_extents(coords):
 def strip_endline(l):
     return l.strip(';\n ')
 
+def format_coord_values(values: np.ndarray, float_style=False) -> str:
+    flat = values.ravel()
+    if float_style:
+        return ','.join(map(repr, flat.tolist()))
+    if np.all(np.floor(flat) == flat):
+        return ','.join(map(str, flat.astype(np.int64).tolist()))
+    return ','.join([str(int(v)) if v.is_integer() else repr(v) for v in flat.tolist()])
+
+def translation(dx: float, dy: float) -> np.ndarray:
+    return np.array([[1.0, 0.0, dx], [0.0, 1.0, dy], [0.0, 0.0, 1.0]])
+
+def scaling(sx: float, sy: Optional[float] = None) -> np.ndarray:
+    return np.diag([sx, sx if sy is None else sy, 1.0])
+
+def rotation(degrees: float) -> np.ndarray:
+    """Counterclockwise about the origin."""
+    c, s = math.cos(math.radians(degrees)), math.sin(math.radians(degrees))
+    return np.array([[c, -s, 0.0], [s, c, 0.0], [0.0, 0.0, 1.0]])
+
+def parse_pair(text: str) -> Tuple[float, float]:
+    """`"X,Y"` as two floats, or `"V"` as the same value twice."""
+    values = [float(v) for v in text.split(',')]
+    if len(values) == 1: return (values[0], values[0])
+    if len(values) != 2: raise ValueError(f"expected one or two numbers, got {text!r}")
+    return (values[0], values[1])
+
+def transform_extents(matrix: np.ndarray, extents) -> Tuple[Tuple[float, float], Tuple[float, float]]:
+    """Extents of the box `extents` once `matrix` is applied to its corners."""
+    (x0, y0), (x1, y1) = extents
+    corners = np.array([[x0, y0, 1], [x1, y0, 1], [x0, y1, 1], [x1, y1, 1]]) @ matrix[:2].T
+    mins, maxes = corners.min(axis=0).tolist(), corners.max(axis=0).tolist()
+    return ((mins[0], mins[1]), (maxes[0], maxes[1]))
+
+def placement_transform(extents, scale=(1.0, 1.0), rotate=0.0, mirror=False, roll_width: Optional[float] = None, offset=(0.0, 0.0)) -> np.ndarray:
+    """
+    One matrix for placing a plot on the material. Scaling (e.g. to make up
+    for shrink), rotating `rotate` degrees counterclockwise and mirroring
+    across the X axis all happen about the lower-left corner of `extents`,
+    which stays put. The plot is then shrunk, never grown, to be at most
+    `roll_width` across in Y, and finally moved by `offset`.
+    """
+    (x0, y0), _ = extents
+    m = scaling(*scale)
+    m = rotation(rotate) @ m
+    if mirror:
+        m = scaling(1.0, -1.0) @ m
+    m = m @ translation(-x0, -y0)
+    (nx0, ny0), (nx1, ny1) = transform_extents(m, extents)
+    m = translation(x0 - nx0, y0 - ny0) @ m
+    if roll_width and ny1 - ny0 > roll_width:
+        m = translation(x0, y0) @ scaling(roll_width / (ny1 - ny0)) @ translation(-x0, -y0) @ m
+    return translation(*offset) @ m
+
+# levels in a block's detail pyramid, see `Block.trace_lod`
+LOD_LEVELS = 12
+
+def lod_level(tolerance: float) -> int:
+    """The coarsest detail pyramid level that stays within `tolerance` plotter units."""
+    if tolerance < 2.0: return 0
+    return min(int(math.log2(tolerance)), LOD_LEVELS - 1)
+
+def simplify_coords(coords: np.ndarray, tolerance: float) -> np.ndarray:
+    """
+    Douglas-Peucker: drops the vertices of a polyline that lie within
+    `tolerance` of the simplified one. The first and last vertex always stay,
+    and closed polylines stay closed. Every pending span is split in the same
+    pass, so the loop runs once per level of recursion.
+    """
+    n = len(coords)
+    if n < 3 or tolerance <= 0: return coords
+    return coords[_simplify_spans(coords, np.array([0]), np.array([n - 1]), tolerance)]
+
+def simplify_traces(traces: List[np.ndarray], tolerance: float) -> List[np.ndarray]:
+    """`simplify_coords` for many polylines at once, sharing each pass between them."""
+    if tolerance <= 0 or not traces: return list(traces)
+    lengths = np.array([len(t) for t in traces])
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    coords = np.concatenate(traces)
+    wide = lengths > 2
+    keep = _simplify_spans(coords, starts[wide], ends[wide] - 1, tolerance)
+    keep[starts[~wide]] = keep[np.maximum(ends[~wide] - 1, 0)] = True
+    kept = np.concatenate(([0], np.cumsum(keep)))
+    return np.split(coords[keep], kept[ends[:-1]])
+
+def _simplify_spans(coords: np.ndarray, starts: np.ndarray, ends: np.ndarray, tolerance: float) -> np.ndarray:
+    keep = np.zeros(len(coords), dtype=bool)
+    keep[starts] = keep[ends] = True
+    while len(starts):
+        lengths = ends - starts - 1
+        span = np.repeat(np.arange(len(starts)), lengths)
+        first = np.cumsum(lengths) - lengths
+        points = np.arange(len(span)) - first[span] + starts[span] + 1
+
+        a, b = coords[starts[span]], coords[ends[span]]
+        ab = b - a
+        length_sq = np.einsum('ij,ij->i', ab, ab)
+        t = np.einsum('ij,ij->i', coords[points] - a, ab) / np.where(length_sq > 0, length_sq, 1)
+        nearest = a + ab * np.clip(t, 0, 1)[:, None]
+        distance = np.hypot(*(coords[points] - nearest).T)
+
+        # farthest vertex of each span, the last one on ties
+        farthest = np.flatnonzero(distance == np.maximum.reduceat(distance, first)[span])
+        last = farthest[np.append(span[farthest][1:] != span[farthest][:-1], True)]
+        split = distance[last] > tolerance
+        pivots = points[last[split]]
+        keep[pivots] = True
+        starts, ends = np.concatenate((starts[split], pivots)), np.concatenate((pivots, ends[split]))
+        wide = ends - starts > 1
+        starts, ends = starts[wide], ends[wide]
+    return keep
+
+def format_ints(values: np.ndarray) -> str:
+    return ','.join(map(str, values.ravel().tolist()))
+
+def encode_pe_numbers(values: np.ndarray) -> str:
+    """
+    HPGL/2 `PE` 7-bit encoding of integers: sign moved to the low bit, then
+    base 32 digits, least significant first, the last one marked.
+    """
+    values = np.asarray(values, dtype=np.int64).ravel()
+    if not len(values): return ''
+    z = np.where(values >= 0, values * 2, -values * 2 + 1)
+    digits = np.ones(len(z), dtype=np.int64)
+    while np.any(z >> (5 * digits)):
+        digits += (z >> (5 * digits)) != 0
+    positions = np.arange(digits.max())
+    codes = ((z[:, None] >> (5 * positions)) & 31) + np.where(positions == digits[:, None] - 1, 95, 63)
+    return codes[positions < digits[:, None]].astype(np.uint8).tobytes().decode('ascii')
+
+@hpgl_profile.timed('serialize', size=len)
 def flatten_blocks_to_text(blocks: list):
     return "".join(map(str, blocks))
 
+def write_atomic(filename: str, data: Union[str, bytes, Callable[[BinaryIO], Any]]):
+    """
+    Replace `filename` with `data` so readers never see a partial file.
+    `data` is text, bytes, or a function writing to the binary file it's given.
+    """
+    directory, basename = os.path.split(os.path.abspath(filename))
+    fd, temp_name = tempfile.mkstemp(dir=directory, prefix='.' + basename, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w' if isinstance(data, str) else 'wb') as f:
+            if callable(data):
+                data(f)
+            else:
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(filename):
+            shutil.copymode(filename, temp_name)
+        else:
+            os.chmod(temp_name, 0o644)
+        os.replace(temp_name, filename)
+    except BaseException:
+        os.unlink(temp_name)
+        raise
+
 def vector_length(seq):
     nsq = sum(map(lambda s: s * s, seq))
     return math.sqrt(nsq)
@@ -82,82 +269,214 @@ def vector_normalize(seq, xfactor=1.0):
     l = xfactor / vector_length(seq)
     return type(seq)([s * l for s in seq])
 
-def line_to_block(line: shapely.geometry.LineString, pen_number=None):
-    b = Block()
+def line_to_block(line: shapely.geometry.LineString, pen_number=None, simplify=0.0):
     if pen_number is None:
         pen_number = 3 if line.is_ring else 2
-    b.push_back(Statement('SP', [pen_number]))
-    b.push_back(Statement('PU', [line.coords[0]]))
-    b.push_back(Statement('PD', [c for c in line.coords[1:]]))
-    b.push_back(Statement('PU', []))
+    return coords_to_block(shapely.get_coordinates(line), pen_number, simplify)
+
+def coords_to_block(coords: np.ndarray, pen_number: int, simplify=0.0):
+    """
+    Build an `SP`, `PU`, `PD`, `PU` block, same as pushing each statement.
+    With `simplify`, vertices within that distance of a simpler path are
+    dropped; the ends never move.
+    """
+    coords = simplify_coords(coords, simplify)
+    b = Block()
+    b._commands = ['SP', 'PU', 'PD', 'PU']
+    b._tails = [str(pen_number), _FLOAT_TAIL, _FLOAT_TAIL, None]
+    b._offsets = [0, 0, 1, len(coords), len(coords)]
+    b._coords = coords
     return b
 
 
 class Statement:
+    """
+    A single HPGL instruction.
+
+    Statements don't own any data. They are views onto a row of a `Block`,
+    created on demand as the block is iterated. A statement constructed
+    directly gets a private single-statement block, which is copied into the
+    destination by `Block.push_back`.
+    """
+    __slots__ = ('block', 'index')
 
     def __init__(self, line: str, *args):
-        self.command = line[:2]
-        self.tail = ''
-        self.split_tail: List[str] = []
-        self.parsed_args: List[Any] = []
+        builder = BlockBuilder()
+        builder.add(line[:2] if args else line)
+        self.block = builder.build()
+        self.index = 0
 
         if args:
             if type(args[0]) is list:
                 self.set_args(*args[0])
             else:
                 self.set_args(*args)
-        else:
-            self.tail = strip_endline(line[2:])
-            self.split_tail = self.tail.split(',') if self.tail else []
-            self.parsed_args = []
-            self._parse_args()
-    
+
+    @classmethod
+    def view(cls, block: 'Block', index: int) -> 'Statement':
+        s = cls.__new__(cls)
+        s.block = block
+        s.index = index
+        return s
+
     def clone(self):
         return Statement(str(self))
-    
-    def _parse_args(self):
-        if not self.split_tail: return
+
+    @property
+    def command(self) -> str:
+        return self.block._commands[self.index]
+
+    @property
+    def tail(self) -> str:
+        return self.block._statement_tail(self.index)
+
+    @property
+    def split_tail(self) -> List[str]:
+        tail = self.tail
+        return tail.split(',') if tail else []
+
+    @property
+    def parsed_args(self) -> List[Any]:
         if self.needs_coordinates():
-            self.parsed_args = parse_list_as_coords(self.split_tail)
-        elif self.command in ('SP'):
-            self.parsed_args = parse_list_as_type(self.split_tail, int)
+            return list(map(tuple, self.block._statement_coords(self.index).tolist()))
+        if self.command == 'SP':
+            return parse_list_as_type(self.split_tail, int)
+        return []
 
     def __str__(self):
         return f"{self.command}{self.tail};\n"
 
     def __repr__(self):
-        which_args = self.parsed_args if self.parsed_args else self.split_tail
+        parsed_args = self.parsed_args
+        which_args = parsed_args if parsed_args else self.split_tail
         return f"{self.command} {repr(which_args)}"
     
     def needs_coordinates(self) -> bool:
-        return self.command in ('PU', 'PD', 'PA', 'DI', 'SI')
+        return self.command in COORDINATE_COMMANDS
 
     def is_trace(self) -> bool:
-        return self.command in ('PD')
+        return self.command == 'PD'
 
     def set_args(self, *args):
-        self.parsed_args = args[0] if (len(args) == 1 and type(args[0]) == list) else list(args)
-        self.rewrite()
-
-    def rewrite(self):
-        if not self.parsed_args: return
+        parsed_args = args[0] if (len(args) == 1 and type(args[0]) == list) else list(args)
+        if not parsed_args: return
         if self.needs_coordinates():
-            self.split_tail = [str(float(a)) for a in flatten_coords(self.parsed_args)]
+            coords = np.asarray(parsed_args, dtype=np.float64).reshape(-1, 2)
+            self.block._replace_statement(self.index, _FLOAT_TAIL, coords)
         else:
-            self.split_tail = [str(a) for a in self.parsed_args]
-        self.tail = ','.join(self.split_tail)
+            self.block._replace_statement(self.index, ','.join([str(a) for a in parsed_args]))
+
+    def rewrite(self):
+        self.set_args(self.parsed_args)
 
 
 class Block:
+    """
+    A run of statements, normally ending with a bare `PU`.
+
+    All coordinate arguments live in one contiguous (N, 2) array. Each
+    statement owns the rows `_offsets[i]:_offsets[i + 1]` of it. Statement
+    tails are only kept as text when the coordinates can't reproduce them.
+
+    Derived geometry (traces, linestring, extents, pen, closure) is memoized
+    in `_cache` and dropped by whatever mutates the statements it came from.
+
+    Clones share their statements and coordinates with the original until
+    either one changes them. The shared coordinate array is made read-only,
+    and whichever block writes first takes a copy.
+    """
+    __slots__ = ('_commands', '_tails', '_offsets', '_coords', '_cache', '_shared', 'jitter')
+
     def __init__(self):
-        self.commands = []
+        self._commands: List[str] = []
+        self._tails: List[Any] = []
+        self._offsets: List[int] = [0]
+        self._coords = np.empty((0, 2))
+        self._cache: Dict[str, Any] = {}
+        self._shared = False
         self.jitter = vector_normalize((random.uniform(-1, 1), random.uniform(-1, 1)), random.uniform(50, 150))
 
-    def clone(self) -> Block:
+    def clone(self) -> 'Block':
         o = Block()
-        o.commands = [c.clone() for c in self.commands]
+        o._commands = self._commands
+        o._tails = self._tails
+        o._offsets = self._offsets
+        o._coords = self._coords
+        o._coords.flags.writeable = False
+        o._cache = self._cache.copy()
         o.jitter = self.jitter
+        self._shared = o._shared = True
         return o
+
+    def with_pen(self, pen_number: int) -> 'Block':
+        """A clone drawn with another pen, leaving this block as it is."""
+        o = self.clone()
+        o.set_pen(pen_number)
+        return o
+
+    def _own(self, coords=False):
+        """Take private copies of storage shared with clones before changing it."""
+        if self._shared:
+            self._commands = self._commands[:]
+            self._tails = self._tails[:]
+            self._offsets = self._offsets[:]
+            self._shared = False
+        if coords and not self._coords.flags.writeable:
+            self._coords = self._coords.copy()
+
+    def _cached(self, key: str, compute: Callable[[], Any]) -> Any:
+        try:
+            value = self._cache[key]
+        except KeyError:
+            geometry_cache_stats['misses'] += 1
+            value = self._cache[key] = compute()
+            return value
+        geometry_cache_stats['hits'] += 1
+        return value
+
+    def _invalidate(self, command: Optional[str] = None):
+        global _geometry_generation
+        if command == 'SP':
+            self._cache.pop('pen', None)
+        elif command is None or command in ('PU', 'PD'):
+            if 'trace' in self._cache:
+                _geometry_generation += 1
+            self._cache.clear()
+
+    @property
+    def commands(self) -> List[Statement]:
+        return list(self)
+
+    @property
+    def coords(self) -> np.ndarray:
+        """Every coordinate argument in the block. Treat as read-only."""
+        return self._coords
+
+    def _statement_coords(self, index: int) -> np.ndarray:
+        return self._coords[self._offsets[index]:self._offsets[index + 1]]
+
+    def _statement_tail(self, index: int) -> str:
+        tail = self._tails[index]
+        if isinstance(tail, str): return tail
+        coords = self._statement_coords(index)
+        if not len(coords): return ''
+        return format_coord_values(coords, tail is _FLOAT_TAIL)
+
+    def _replace_statement(self, index: int, tail, coords: Optional[np.ndarray] = None):
+        if coords is None: coords = np.empty((0, 2))
+        start, stop = self._offsets[index], self._offsets[index + 1]
+        self._own()
+        self._tails[index] = tail
+        self._invalidate(self._commands[index])
+        delta = len(coords) - (stop - start)
+        if not delta:
+            if start < stop:
+                self._own(coords=True)
+                self._coords[start:stop] = coords
+            return
+        self._coords = np.concatenate((self._coords[:start], coords, self._coords[stop:]))
+        for i in range(index + 1, len(self._offsets)):
+            self._offsets[i] += delta
     
     def repeat_continuous_trace(self, count: int):
         pd_statement = self.get_statement('PD')
@@ -165,69 +484,286 @@ class Block:
         pd_statement.set_args(pd_statement.parsed_args * count)
     
     def get_statement(self, cmd: str) -> Optional[Statement]:
-        for s in self:
-            if s.command == cmd:
-                return s
+        for s in self.find_statements(cmd):
+            return s
         return None
 
+    def find_statements(self, *commands) -> Iterator[Statement]:
+        for i, c in enumerate(self._commands):
+            if c in commands:
+                yield Statement.view(self, i)
+
     def push_back(self, statement: Statement):
-        self.commands.append(statement)
+        source, index = statement.block, statement.index
+        coords = source._statement_coords(index)
+        self._own()
+        self._commands.append(source._commands[index])
+        self._tails.append(source._tails[index])
+        if len(coords):
+            self._coords = np.concatenate((self._coords, coords))
+        self._offsets.append(self._offsets[-1] + len(coords))
+        statement.block, statement.index = self, len(self._commands) - 1
+        self._invalidate()
     
     def __repr__(self):
-        return '***\n' + "\n".join(map(lambda s: "\t" + repr(s), self.commands))
+        return '***\n' + "\n".join(map(lambda s: "\t" + repr(s), self))
     
     def __str__(self):
-        return "".join(map(str, self.commands))
+        return "".join(map(str, self))
 
     def __iter__(self) -> Iterator[Statement]:
-        return iter(self.commands)
+        return (Statement.view(self, i) for i in range(len(self._commands)))
+
+    def encode(self, encoding='verbatim') -> str:
+        """Serializes the block for sending to a plotter, in one of `ENCODINGS`."""
+        if encoding == 'verbatim':
+            return str(self)
+        if encoding not in ENCODINGS:
+            raise ValueError("Unknown encoding: " + encoding)
+        runs = self._compact_runs()
+        if encoding == 'pe':
+            return self._encode_pe(runs)
+        return ''.join(f"{c}{format_ints(v) if isinstance(v, np.ndarray) else v};" for c, v in runs)
+
+    def simplify(self, tolerance: float) -> Tuple[int, int]:
+        """
+        Drops trace vertices within `tolerance` plotter units of a simpler
+        path, keeping both ends. Only touches blocks that draw a single
+        `PU`/`PD` path. Returns the vertex counts before and after.
+        """
+        trace = self.trace_array()
+        count = len(trace) if trace is not None else 0
+        rows = self._simple_path_rows()
+        if rows is None or tolerance <= 0: return count, count
+        first, last = rows
+        simplified = simplify_coords(self._coords[first:last], tolerance)
+        if len(simplified) < last - first:
+            # the PD right after the single-row PU
+            pd_index = self._offsets.index(first + 1)
+            tail = self._tails[pd_index]
+            self._replace_statement(pd_index, tail if tail is _FLOAT_TAIL else None, simplified[1:])
+        return count, len(simplified)
+
+    def _compact_runs(self) -> List[Tuple[str, Any]]:
+        """
+        Statements as (command, integer coords or tail). Runs of the same pen
+        command are merged, pen-up moves keep only where they end up, and
+        pen-down moves that go nowhere are dropped.
+        """
+        runs: List[Tuple[str, Any]] = []
+        for i, c in enumerate(self._commands):
+            if c in ('PU', 'PD', 'PA'):
+                coords = np.rint(self._statement_coords(i)).astype(np.int64)
+                if runs and runs[-1][0] == c and c != 'PA':
+                    coords = np.concatenate((runs[-1][1], coords))
+                    runs.pop()
+                runs.append((c, coords[-1:] if c == 'PU' else coords))
+            else:
+                runs.append((c, self._statement_tail(i)))
+
+        position = None
+        for r, (c, coords) in enumerate(runs):
+            if c not in ('PU', 'PD', 'PA') or not len(coords): continue
+            if c == 'PD':
+                previous = np.concatenate(([position], coords[:-1])) if position is not None else coords[:-1]
+                moved = np.ones(len(coords), dtype=bool)
+                moved[len(coords) - len(previous):] = np.any(coords[len(coords) - len(previous):] != previous, axis=1)
+                runs[r] = (c, coords[moved])
+            position = coords[-1]
+        return runs
+
+    def _encode_pe(self, runs: List[Tuple[str, Any]]) -> str:
+        out = []
+        polyline = []
+        position = None
+
+        def flush():
+            if polyline:
+                out.append('PE7' + ''.join(polyline) + ';')
+                polyline.clear()
+
+        for c, coords in runs:
+            if c in ('PU', 'PD') and len(coords):
+                if c == 'PU':
+                    polyline.append('<=' + encode_pe_numbers(coords))
+                elif position is None:
+                    polyline.append('=' + encode_pe_numbers(coords[:1]) + encode_pe_numbers(np.diff(coords, axis=0)))
+                else:
+                    polyline.append(encode_pe_numbers(np.diff(np.concatenate(([position], coords)), axis=0)))
+                position = coords[-1]
+                continue
+            flush()
+            if c == 'PA' and len(coords):
+                position = coords[-1]
+            out.append(f"{c}{format_ints(coords) if isinstance(coords, np.ndarray) else coords};")
+        flush()
+        return ''.join(out)
         
     def cuttable(self):
         return self.has_trace()
     
     def has_trace(self):
-        return any(map(Statement.is_trace, self.commands))
+        return 'PD' in self._commands
 
     def extents(self) -> Tuple[Tuple[float, float], Tuple[float, float]]:
-        ls = self.linestring()
-        if not ls: return ((0, 0), (0, 0))
-        bounds = ls.bounds
-        return ((bounds[0], bounds[1]), (bounds[2], bounds[3]))
+        return self._cached('extents', self._compute_extents)
+
+    def _compute_extents(self):
+        trace = self.trace_array()
+        if trace is None or not len(trace): return ((0, 0), (0, 0))
+        mins, maxes = trace.min(axis=0).tolist(), trace.max(axis=0).tolist()
+        return ((mins[0], mins[1]), (maxes[0], maxes[1]))
 
     def has_statement(self, *args):
-        for s in self:
-            if s.command in args:
+        for c in self._commands:
+            if c in args:
                 return True
         return False
 
     def get_pen(self) -> Optional[int]:
-        for s in self:
-            if s.command == 'SP':
-                return s.parsed_args[0]
+        return self._cached('pen', self._compute_pen)
+
+    def _compute_pen(self):
+        for c, tail in zip(self._commands, self._tails):
+            if c == 'SP':
+                return int(tail.split(',')[0])
         return None
     
     def set_pen(self, pen_number: int):
-        for s in self:
-            if s.command == 'SP':
-                s.set_args(pen_number)
-                break
+        s = self.get_statement('SP')
+        if s: s.set_args(pen_number)
 
-    def trace(self, do_jitter=False) -> Optional[List[Tuple[float, float]]]:
-        if not self.has_trace(): return None
-        block_trace = []
-        for cmd in self:
-            if cmd.command == 'PU' and cmd.parsed_args:
-                block_trace.append(cmd.parsed_args[0])
-            if cmd.command == 'PD':
-                block_trace.extend(cmd.parsed_args)
+    def trace_array(self, do_jitter=False) -> Optional[np.ndarray]:
+        """The trace as a read-only (N, 2) array, or None if nothing is drawn."""
         if do_jitter:
-            block_trace = [(x + self.jitter[0], y + self.jitter[1]) for x, y in block_trace]
-        return block_trace
+            return self._cached('jittered_trace', self._compute_jittered_trace)
+        return self._cached('trace', self._compute_trace)
+
+    def trace_lod(self, level: int) -> Optional[np.ndarray]:
+        """
+        The trace from level `level` of its detail pyramid: simplified to
+        within `2 ** level` plotter units, cached per level. Level 0 is the
+        full trace.
+        """
+        trace = self.trace_array()
+        if not level or trace is None: return trace
+        return self._cached(('lod', level), lambda: self._compute_trace_lod(trace, level))
+
+    @staticmethod
+    def _compute_trace_lod(trace, level):
+        trace = simplify_coords(trace, 2.0 ** level)
+        trace.flags.writeable = False
+        return trace
+
+    @staticmethod
+    def build_lods(blocks: Iterable['Block'], level: int):
+        """Fill in `trace_lod(level)` for many blocks, simplifying the missing traces together."""
+        if not level: return
+        key = ('lod', level)
+        missing = [b for b in blocks if key not in b._cache and b.trace_array() is not None]
+        for b, trace in zip(missing, simplify_traces([b.trace_array() for b in missing], 2.0 ** level)):
+            trace.flags.writeable = False
+            b._cache[key] = trace
+
+    def _compute_jittered_trace(self):
+        trace = self.trace_array()
+        if trace is None: return None
+        trace = trace + self.jitter
+        trace.flags.writeable = False
+        return trace
+
+    def _compute_trace(self):
+        if not self.has_trace(): return None
+        pieces = []
+        for i, c in enumerate(self._commands):
+            start, stop = self._offsets[i], self._offsets[i + 1]
+            if c == 'PU' and stop > start:
+                pieces.append(self._coords[start:start + 1])
+            elif c == 'PD':
+                pieces.append(self._coords[start:stop])
+        trace = np.concatenate(pieces) if pieces else np.empty((0, 2))
+        trace.flags.writeable = False
+        return trace
+
+    def trace(self, do_jitter=False) -> Optional[List[Tuple[float, float]]]:
+        trace = self._cached('jittered_trace_list' if do_jitter else 'trace_list', lambda: self._compute_trace_list(do_jitter))
+        return None if trace is None else trace[:]
+
+    def _compute_trace_list(self, do_jitter):
+        trace = self.trace_array(do_jitter)
+        if trace is None: return None
+        return list(map(tuple, trace.tolist()))
 
     def linestring(self, do_jitter=False) -> Optional[shapely.geometry.LineString]:
-        trace = self.trace(do_jitter)
-        if not trace: return None
-        return shapely.geometry.LineString([shapely.geometry.Point(p) for p in trace])
+        return self._cached('jittered_linestring' if do_jitter else 'linestring', lambda: self._compute_linestring(do_jitter))
+
+    def _compute_linestring(self, do_jitter):
+        trace = self.trace_array(do_jitter)
+        if trace is None or not len(trace): return None
+        return shapely.geometry.LineString(trace)
+
+    def is_closed(self) -> bool:
+        return self._cached('closed', self._compute_closed)
+
+    def _compute_closed(self):
+        trace = self.trace_array()
+        if trace is None or len(trace) < 2: return False
+        return bool(np.array_equal(trace[0], trace[-1]))
+
+    def _simple_path_rows(self) -> Optional[Tuple[int, int]]:
+        """
+        Coordinate rows of the `PU x,y;PD ...` pair if that's the only thing
+        the block draws, so its trace can be rewritten in place.
+        """
+        pu_index = None
+        for i, c in enumerate(self._commands):
+            rows = self._offsets[i + 1] - self._offsets[i]
+            if c == 'PU' and rows:
+                if pu_index is not None or rows != 1: return None
+                pu_index = i
+            elif c == 'PD' and (pu_index is None or i != pu_index + 1):
+                return None
+        if pu_index is None or pu_index + 1 >= len(self._commands) or self._commands[pu_index + 1] != 'PD':
+            return None
+        return self._offsets[pu_index], self._offsets[pu_index + 2]
+
+    def is_reorientable(self) -> bool:
+        return self._cached('reorientable', lambda: self._simple_path_rows() is not None)
+
+    def reoriented(self, start=0, reverse=False) -> 'Block':
+        """
+        A copy drawing the same path reversed, or for a closed trace starting
+        from vertex `start`. Only valid if `is_reorientable()`.
+        """
+        first, last = self._simple_path_rows() # type: ignore
+        trace = self._coords[first:last]
+        if start:
+            trace = np.concatenate((np.roll(trace[:-1], -start, axis=0), trace[start:start + 1]))
+        if reverse:
+            trace = trace[::-1]
+        o = self.clone()
+        o._own(coords=True)
+        o._coords[first:last] = trace
+        for i in range(len(o._tails)):
+            if o._commands[i] in ('PU', 'PD') and isinstance(o._tails[i], str):
+                o._tails[i] = None
+        o._invalidate()
+        return o
+
+    def serpentine(self, count: int) -> 'Block':
+        """
+        A copy going over its path `count` times without lifting, every other
+        time backwards. Only valid if `is_reorientable()`.
+        """
+        first, last = self._simple_path_rows() # type: ignore
+        trace = self._coords[first:last]
+        laps = [trace[::-1][1:] if i % 2 else trace[1:] for i in range(count)]
+        o = self.clone()
+        if count > 1:
+            pd_index = o._offsets.index(first + 1)
+            tail = o._tails[pd_index]
+            o._replace_statement(pd_index, tail if tail is _FLOAT_TAIL else None, np.concatenate(laps))
+        return o
 
     def distance_to_trace(self, point: Tuple[float, float], do_jitter=False) -> float:
         trace_string = self.linestring(do_jitter)
@@ -264,10 +800,295 @@ class Block:
         return text_params
 
 
+class BlockIndex:
+    """
+    STRtree over every trace segment of a set of blocks, for picking.
+
+    Blocks added or removed after the tree is built are tracked on the side
+    and folded in by a rebuild once there are enough of them.
+    """
+    REBUILD_THRESHOLD = 256
+
+    def __init__(self, blocks: Iterable[Block]):
+        self.rebuild(blocks)
+
+    def rebuild(self, blocks: Iterable[Block]):
+        self.blocks: List[Block] = []
+        starts, ends, owners = [], [], []
+        for b in blocks:
+            trace = b.trace_array()
+            if trace is None or not len(trace): continue
+            if len(trace) == 1:
+                trace = np.concatenate((trace, trace))
+            starts.append(trace[:-1])
+            ends.append(trace[1:])
+            owners.append(np.full(len(trace) - 1, len(self.blocks)))
+            self.blocks.append(b)
+
+        if self.blocks:
+            segments = np.stack((np.concatenate(starts), np.concatenate(ends)), axis=1)
+            self.tree = shapely.STRtree(shapely.linestrings(segments))
+            self.owners = np.concatenate(owners)
+        else:
+            self.tree = None
+            self.owners = np.empty(0, dtype=int)
+        self.max_jitter = max((vector_length(b.jitter) for b in self.blocks), default=0.0)
+        self.added: List[Block] = []
+        self.removed: Set[Block] = set()
+        self.generation = _geometry_generation
+
+    def add(self, block: Block):
+        self.update(added=[block])
+
+    def remove(self, block: Block):
+        self.update(removed=[block])
+
+    def update(self, added: Iterable[Block] = (), removed: Iterable[Block] = ()):
+        """Take out `removed` and add `added`, rebuilding at most once for the lot."""
+        gone = set(removed)
+        if gone:
+            kept = [b for b in self.added if b not in gone]
+            self.removed |= gone.difference(self.added)
+            self.added = kept
+        for b in added:
+            self.added.append(b)
+            self.max_jitter = max(self.max_jitter, vector_length(b.jitter))
+        if len(self.added) > self.REBUILD_THRESHOLD or len(self.removed) > self.REBUILD_THRESHOLD:
+            self.rebuild(self.all_blocks())
+
+    def replace(self, replacements: Dict[Block, Block]):
+        """Swap blocks for replacements, in place where the trace is the very same array."""
+        same = {}
+        for old, new in replacements.items():
+            if old.trace_array() is new.trace_array():
+                same[old] = new
+            else:
+                self.remove(old)
+                self.add(new)
+        if not same: return
+        self.blocks = [same.get(b, b) for b in self.blocks]
+        self.added = [same.get(b, b) for b in self.added]
+        self.removed = {same.get(b, b) for b in self.removed}
+
+    def all_blocks(self) -> List[Block]:
+        return [b for b in self.blocks if b not in self.removed] + self.added
+
+    def candidates(self, point: Coord, radius: float) -> List[Block]:
+        """Blocks that may have a trace within `radius` of `point`, in plot order."""
+        retval = []
+        if self.tree is not None:
+            x, y = point
+            hits = self.tree.query(shapely.box(x - radius, y - radius, x + radius, y + radius))
+            retval = [self.blocks[i] for i in np.unique(self.owners[hits])]
+            if self.removed:
+                retval = [b for b in retval if b not in self.removed]
+        return retval + self.added
+
+    def nearest(self, point: Coord, max_distance=200, do_jitter=False) -> List[Block]:
+        """
+        All blocks tied for closest to `point`, no further than `max_distance`.
+        Blocks lying exactly under the point are skipped.
+        """
+        radius = max_distance + (self.max_jitter if do_jitter else 0)
+        best_matches, distance = [], max_distance
+        for b in self.candidates(point, radius):
+            d = b.distance_to_trace(point, do_jitter)
+            if d:
+                if d == distance:
+                    best_matches.append(b)
+                elif d < distance:
+                    distance = d
+                    best_matches = [b]
+        return best_matches
+
+
+class EndpointIndex:
+    """
+    Hash from trace endpoints to the blocks starting or ending there.
+
+    With a tolerance, endpoints are snapped to a grid of that pitch and
+    matches are looked for in the neighbouring cells as well, then checked
+    by distance like `extend_line(..., fuzzy=tolerance)`.
+    """
+
+    def __init__(self, blocks: Iterable[Block], tolerance=0.0):
+        self.tolerance = tolerance
+        self.rebuild(blocks)
+
+    def rebuild(self, blocks: Iterable[Block]):
+        self.cells: Dict[Any, List[Block]] = defaultdict(list)
+        self.endpoints: Dict[Block, Tuple[Coord, Coord]] = {}
+        self.order: Dict[Block, int] = {}
+        self.next_order = 0
+        for b in blocks:
+            self.add(b)
+        self.generation = _geometry_generation
+
+    def _key(self, point: Coord):
+        if not self.tolerance: return point
+        return (math.floor(point[0] / self.tolerance), math.floor(point[1] / self.tolerance))
+
+    def add(self, block: Block):
+        self.order[block] = self.next_order
+        self.next_order += 1
+        trace = block.trace_array()
+        if trace is None or not len(trace): return
+        ends = (tuple(trace[0].tolist()), tuple(trace[-1].tolist()))
+        self.endpoints[block] = ends
+        for p in set(ends):
+            self.cells[self._key(p)].append(block)
+
+    def remove(self, block: Block):
+        self.order.pop(block, None)
+        ends = self.endpoints.pop(block, None)
+        if not ends: return
+        for p in set(ends):
+            key = self._key(p)
+            self.cells[key].remove(block)
+            if not self.cells[key]: del self.cells[key]
+
+    def replace(self, old: Block, new: Block):
+        """Swap `old` for `new`, which takes its place in the plot order."""
+        order = self.order.get(old)
+        self.remove(old)
+        self.add(new)
+        if order is not None:
+            self.order[new] = order
+
+    def touching(self, point: Coord) -> Set[Block]:
+        if not self.tolerance:
+            return set(self.cells.get(point, ()))
+        cx, cy = self._key(point)
+        retval = set()
+        for x in (cx - 1, cx, cx + 1):
+            for y in (cy - 1, cy, cy + 1):
+                for b in self.cells.get((x, y), ()):
+                    if any(dist(point, e) <= self.tolerance for e in self.endpoints[b]):
+                        retval.add(b)
+        return retval
+
+    def neighbours(self, block: Block) -> List[Block]:
+        """Blocks sharing an endpoint with `block`, in plot order."""
+        found: Set[Block] = set()
+        for p in self.endpoints.get(block, ()):
+            found |= self.touching(p)
+        found.discard(block)
+        return sorted(found, key=self.order.__getitem__)
+
+    def component(self, block: Block) -> List[Block]:
+        """Depth-first walk of everything connected to `block`."""
+        retval = [block]
+        seen = {block}
+        stack = [iter(self.neighbours(block))]
+        while stack:
+            for b in stack[-1]:
+                if b in seen: continue
+                seen.add(b)
+                retval.append(b)
+                stack.append(iter(self.neighbours(b)))
+                break
+            else:
+                stack.pop()
+        return retval
+
+
 class HPGLPlot:
     def __init__(self):
         self.blocks = []
         self.init_statements = {}
+
+    @property
+    def blocks(self) -> List[Block]:
+        return self._blocks
+
+    @blocks.setter
+    def blocks(self, blocks: List[Block]):
+        self._blocks = blocks
+        self._extents = None
+        self._extents_key = None
+        self._index = None
+        self._endpoint_indexes: Dict[float, EndpointIndex] = {}
+
+    def add_block(self, block: Block):
+        """Append a block, growing the cached extents rather than dropping them."""
+        fresh = self._extents is not None and self._extents_key == (len(self._blocks), _geometry_generation)
+        self._blocks.append(block)
+        if self._index is not None:
+            self._index.add(block)
+        for endpoints in self._endpoint_indexes.values():
+            endpoints.add(block)
+        if not fresh: return
+        if block.trace_array() is not None:
+            self._extents = coord_extents(list(self._extents) + list(block.extents()))
+        self._extents_key = (len(self._blocks), _geometry_generation)
+
+    def remove_block(self, block: Block):
+        self._blocks.remove(block)
+        self._extents = None
+        if self._index is not None:
+            self._index.remove(block)
+        for endpoints in self._endpoint_indexes.values():
+            endpoints.remove(block)
+
+    def change_blocks(self, removed: Iterable[Block] = (), added: Iterable[Block] = ()):
+        """
+        Take out `removed` and append `added` in one go. The indexes are
+        updated rather than dropped, like `remove_block` and `add_block`.
+        """
+        removed, added = set(removed), list(added)
+        if removed:
+            self._blocks = [b for b in self._blocks if b not in removed]
+        self._blocks.extend(added)
+        self._extents = None
+        if self._index is not None:
+            self._index.update(added, removed)
+        for endpoints in self._endpoint_indexes.values():
+            for b in removed:
+                endpoints.remove(b)
+            for b in added:
+                endpoints.add(b)
+
+    def replace_blocks(self, replacements: Dict[Block, Block]):
+        """
+        Swap blocks for their replacements, e.g. clones with another pen, in
+        place. The caches are updated rather than dropped.
+        """
+        if not replacements: return
+        self._blocks = [replacements.get(b, b) for b in self._blocks]
+        if any(old.trace_array() is not new.trace_array() for old, new in replacements.items()):
+            self._extents = None
+        if self._index is not None:
+            self._index.replace(replacements)
+        for endpoints in self._endpoint_indexes.values():
+            for old, new in replacements.items():
+                endpoints.replace(old, new)
+
+    def take_indexes(self, other: 'HPGLPlot'):
+        """
+        Move the spatial and endpoint indexes of `other` over to this plot,
+        updated for the blocks the two don't have in common.
+        """
+        mine, theirs = set(self._blocks), set(other._blocks)
+        gone = [b for b in other._blocks if b not in mine]
+        added = [b for b in self._blocks if b not in theirs]
+        self._index, other._index = other._index, None
+        self._endpoint_indexes, other._endpoint_indexes = other._endpoint_indexes, {}
+        for index in chain([self._index] if self._index is not None else [], self._endpoint_indexes.values()):
+            for b in gone:
+                index.remove(b)
+            for b in added:
+                index.add(b)
+
+    def spatial_index(self) -> BlockIndex:
+        if self._index is None or self._index.generation != _geometry_generation:
+            self._index = BlockIndex(self._blocks)
+        return self._index
+
+    def endpoint_index(self, tolerance=0.0) -> EndpointIndex:
+        index = self._endpoint_indexes.get(tolerance)
+        if index is None or index.generation != _geometry_generation:
+            index = self._endpoint_indexes[tolerance] = EndpointIndex(self._blocks, tolerance)
+        return index
     
     def clone(self):
         o = HPGLPlot()
@@ -276,12 +1097,12 @@ class HPGLPlot:
         return o
     
     def find_inits(self):
-        for statement in self.linear():
-            if statement.command in ('IP', 'SC'):
-                self.init_statements[statement.command] = statement        
+        for b in self.blocks:
+            for statement in b.find_statements('IP', 'SC'):
+                self.init_statements[statement.command] = statement
 
     def push_block(self):
-        self.blocks.append(Block())
+        self.add_block(Block())
     
     def push_statement(self, statement: Statement):
         if statement.command in ('IP', 'SC'):
@@ -291,14 +1112,8 @@ class HPGLPlot:
     def last_block(self):
         return self.blocks[-1]
 
-    def connectivity(self, block, retval=None):
-        if retval is None: retval = []
-        retval.append(block)
-        for b in self:
-            if b in retval: continue
-            if b.connects_to(block.trace(), retval):
-                self.connectivity(b, retval)
-        return retval
+    def connectivity(self, block, tolerance=0.0):
+        return self.endpoint_index(tolerance).component(block)
 
     def __iter__(self):
         return iter(self.blocks)
@@ -311,9 +1126,72 @@ class HPGLPlot:
     
     def __str__(self):
         return "".join(map(str, iter(self)))
+
+    def encode(self, encoding='verbatim') -> str:
+        return "".join(b.encode(encoding) for b in self)
     
     def extents(self):
-        return coord_extents(list(chain(*map(Block.extents, filter(Block.has_trace, self.blocks)))))
+        key = (len(self._blocks), _geometry_generation)
+        if self._extents is not None and self._extents_key == key:
+            geometry_cache_stats['hits'] += 1
+            return self._extents
+        geometry_cache_stats['misses'] += 1
+        traced = [b for b in self.blocks if b.trace_array() is not None]
+        self._extents = coord_extents(list(chain(*map(Block.extents, traced))))
+        self._extents_key = key
+        return self._extents
+
+    @hpgl_profile.timed('transform')
+    def transform(self, matrix: np.ndarray):
+        """
+        Apply the 3x3 affine `matrix` to every block's coordinates in one go:
+        pen moves and label origins as points, label directions as vectors.
+        Label sizes are left alone. Transformed statements are written out
+        canonically from then on, and the cached extents are worked out from
+        the new coordinates rather than block by block.
+        """
+        global _geometry_generation
+        blocks = [b for b in self.blocks if len(b._coords)]
+        if not blocks: return
+        coords = np.concatenate([b._coords for b in blocks])
+        # 1 for points, 0 for direction vectors
+        shift = np.ones(len(coords))
+        kept, traced = [], np.zeros(len(coords), dtype=bool)
+        row = 0
+        for b in blocks:
+            b._own()
+            drawn = 'PD' in b._commands
+            for i, c in enumerate(b._commands):
+                start, stop = row + b._offsets[i], row + b._offsets[i + 1]
+                if start == stop: continue
+                if c == 'SI':
+                    kept.append((start, stop))
+                    continue
+                if c == 'DI':
+                    shift[start:stop] = 0
+                elif drawn and c == 'PD':
+                    traced[start:stop] = True
+                elif drawn and c == 'PU':
+                    traced[start] = True
+                if isinstance(b._tails[i], str):
+                    b._tails[i] = None
+            row += len(b._coords)
+
+        moved = coords @ matrix[:2, :2].T + shift[:, None] * matrix[:2, 2]
+        for start, stop in kept:
+            moved[start:stop] = coords[start:stop]
+        ends = np.cumsum([len(b._coords) for b in blocks])
+        for b, c in zip(blocks, np.split(moved, ends[:-1])):
+            b._coords = c
+            b._invalidate()
+        _geometry_generation += 1
+
+        if traced.any():
+            mins, maxes = moved[traced].min(axis=0).tolist(), moved[traced].max(axis=0).tolist()
+            self._extents = ((mins[0], mins[1]), (maxes[0], maxes[1]))
+            self._extents_key = (len(self._blocks), _geometry_generation)
+        else:
+            self._extents = None
 
     def mirror(self):
         bounds = self.extents()
@@ -325,6 +1203,7 @@ class HPGLPlot:
             if b.has_statement('IN'): return b
         return Block()
 
+    @hpgl_profile.timed('passes')
     def find_passes(self):
         passes = {'init': [self.get_init_block()], 'pen': [], 'knife': [], 'labels': []}
         
@@ -341,110 +1220,692 @@ class HPGLPlot:
         return passes
 
 
-def parse_lines(lines):
-    plot = HPGLPlot()
-    plot.push_block()
+def tokenize(chunks: Iterable[str]) -> Iterator[str]:
+    """
+    Split HPGL text into statements, independent of line breaks.
 
-    for l in lines:
-        statement = Statement(l)
-        plot.push_statement(statement)
-        if statement.command == 'PU' and not statement.tail:
-            plot.push_block()
+    Statements end at `;`, except `LB` labels, which run to the current `DT`
+    terminator and may contain `;` themselves.
+    """
+    terminator = DEFAULT_LABEL_TERMINATOR
+    partial, label = '', None
+    for chunk in chain(chunks, [None]):
+        if chunk is None:
+            pieces, partial = [partial], ''
+        else:
+            pieces = (partial + chunk).split(';')
+            partial = pieces.pop()
 
-    if plot.blocks[-1].has_statement('IN', 'PG'):
-        plot.blocks.pop(-1)
+        for piece in pieces:
+            if label is not None:
+                piece, label = label + ';' + piece, None
+            else:
+                piece = piece.strip()
+
+            while piece:
+                if piece.startswith('LB'):
+                    end = piece.find(terminator, 2)
+                    if end < 0:
+                        label = piece
+                        break
+                    yield piece[:end + 1]
+                    piece = piece[end + 1:].strip()
+                    continue
+                if piece.startswith('DT'):
+                    terminator = piece[2] if len(piece) > 2 else DEFAULT_LABEL_TERMINATOR
+                yield piece
+                break
+
+    if label is not None:
+        yield label
 
+
+class BlockBuilder:
+    """Accumulates statement text for one `Block` and packs it on `build()`."""
+    __slots__ = ('commands', 'tails', 'offsets', 'values')
+
+    def __init__(self):
+        self.commands: List[str] = []
+        self.tails: List[Optional[str]] = []
+        self.offsets = [0]
+        self.values: List[str] = []
+
+    def add(self, text: str) -> bool:
+        """Add one statement. Returns True if it was a bare `PU`, ending the block."""
+        command = text[:2]
+        tail = strip_endline(text[2:])
+        self.commands.append(command)
+        if command in COORDINATE_COMMANDS:
+            values = tail.split(',') if tail else []
+            count = len(values) & ~1
+            if count == len(values) and (not tail or _INTEGER_TAIL.fullmatch(tail)):
+                self.tails.append(None)
+            else:
+                self.tails.append(tail)
+                del values[count:]
+            self.values.extend(values)
+            self.offsets.append(self.offsets[-1] + count // 2)
+        else:
+            self.tails.append(tail)
+            self.offsets.append(self.offsets[-1])
+        return command == 'PU' and not tail
+
+    def build(self) -> Block:
+        b = Block()
+        b._commands = self.commands
+        b._tails = self.tails
+        b._offsets = self.offsets
+        b._coords = np.array(self.values, dtype=np.float64).reshape(-1, 2)
+        return b
+
+
+def iter_blocks(statements: Iterable[str]) -> Iterator[Block]:
+    """
+    Group statement text into blocks as it arrives. A trailing block holding
+    the `IN`/`PG` epilogue is dropped.
+    """
+    builder = BlockBuilder()
+    for text in statements:
+        if builder.add(text):
+            yield builder.build()
+            builder = BlockBuilder()
+
+    last = builder.build()
+    if not last.has_statement('IN', 'PG'):
+        yield last
+
+# how each statement tail is packed: reproduced from the coordinates, as
+# integers or as floats, or kept as text
+_PACKED_TAILS = (None, _FLOAT_TAIL)
+
+def pack_blocks(blocks: Sequence[Block]) -> Tuple[List[str], Dict[str, np.ndarray]]:
+    """
+    The storage of `blocks` as flat arrays, for `unpack_blocks`: the commands
+    used, then per statement its command, tail kind and coordinate row count,
+    the tails kept as text in one string, and per block its statement count,
+    pen and closure.
+    """
+    table: Dict[str, int] = {}
+    codes, kinds, rows, texts = [], [], [], []
+    for b in blocks:
+        codes.extend(table.setdefault(c, len(table)) for c in b._commands)
+        for t in b._tails:
+            if t is None or t is _FLOAT_TAIL:
+                kinds.append(_PACKED_TAILS.index(t))
+            else:
+                kinds.append(len(_PACKED_TAILS))
+                texts.append(t)
+        offsets = b._offsets
+        rows.extend(offsets[i + 1] - offsets[i] for i in range(len(offsets) - 1))
+    pens = [b.get_pen() for b in blocks]
+    coords = [b._coords for b in blocks if len(b._coords)]
+    return list(table), {
+        'commands': np.array(codes, dtype=np.uint8),
+        'tails': np.array(kinds, dtype=np.uint8),
+        'rows': np.array(rows, dtype=np.int64),
+        'coords': np.concatenate(coords) if coords else np.empty((0, 2)),
+        'text': np.frombuffer("".join(texts).encode('utf-8'), dtype=np.uint8),
+        'text_lengths': np.array([len(t) for t in texts], dtype=np.int64),
+        'statements': np.array([len(b._commands) for b in blocks], dtype=np.int64),
+        'pens': np.array([-1 if p is None else p for p in pens], dtype=np.int64),
+        'closed': np.array([b.is_closed() for b in blocks], dtype=bool),
+    }
+
+def unpack_blocks(commands: Sequence[str], arrays: Dict[str, np.ndarray]) -> List[Block]:
+    """
+    Blocks from `pack_blocks` arrays. Their coordinates are slices of
+    `arrays['coords']`, which may be read-only, e.g. memory mapped; blocks
+    copy them before changing them.
+    """
+    names = [commands[c] for c in arrays['commands'].tolist()]
+    text = arrays['text'].tobytes().decode('utf-8')
+    text_ends = np.cumsum(arrays['text_lengths']).tolist()
+    texts = iter([text[a:b] for a, b in zip([0] + text_ends[:-1], text_ends)])
+    tails = [_PACKED_TAILS[k] if k < len(_PACKED_TAILS) else next(texts) for k in arrays['tails'].tolist()]
+
+    counts = arrays['statements']
+    statement_ends = np.cumsum(counts)
+    row_ends = np.cumsum(arrays['rows'])
+    # each block's first coordinate row, and each statement's end row within its block
+    block_rows = np.concatenate(([0], row_ends))[statement_ends - counts]
+    offsets = (row_ends - np.repeat(block_rows, counts)).tolist()
+    block_rows = block_rows.tolist() + [len(arrays['coords'])]
+
+    coords = arrays['coords']
+    # the same jitter as `Block()` gives, drawn for all of them at once
+    rng = np.random.default_rng(random.getrandbits(64))
+    directions = rng.uniform(-1, 1, (len(counts), 2))
+    directions *= (rng.uniform(50, 150, len(counts)) / np.hypot(directions[:, 0], directions[:, 1]))[:, None]
+    jitters = list(map(tuple, directions.tolist()))
+    blocks = []
+    first = 0
+    for i, (last, pen, closed) in enumerate(zip(statement_ends.tolist(), arrays['pens'].tolist(), arrays['closed'].tolist())):
+        b = Block.__new__(Block)
+        b._shared = False
+        b.jitter = jitters[i]
+        b._commands = names[first:last]
+        b._tails = tails[first:last]
+        b._offsets = [0] + offsets[first:last]
+        b._coords = coords[block_rows[i]:block_rows[i + 1]]
+        b._cache = {'pen': None if pen < 0 else pen, 'closed': closed}
+        blocks.append(b)
+        first = last
+    return blocks
+
+def read_chunks(f, size=READ_CHUNK_SIZE) -> Iterator[str]:
+    return iter(partial(f.read, size), '')
+
+def parse_statements(statements: Iterable[str]) -> HPGLPlot:
+    plot = HPGLPlot()
+    for b in iter_blocks(statements):
+        plot.add_block(b)
+    plot.find_inits()
     return plot
 
+def parse_lines(lines):
+    return parse_statements(tokenize(lines))
+
+@hpgl_profile.timed('parse', blocks=lambda plot: plot.blocks)
 def parse_file(filename):
     with open(filename) as f:
-        return parse_lines(f.readlines())
-
-def render_preview(commands, outfile):
-    subprocess.run(['hp2xx', '-q', '-t', '-x', '0', '-y', '0', '-m', 'png', '-f', outfile], input="".join(map(str, commands)).encode('ASCII'))
-
-def image_preview(commands):
-    completed = subprocess.run(['hp2xx', '-q', '-t', '-x', '0', '-y', '0', '-m', 'png', '-c', '124111', '-f', '-'], input="".join(map(str, commands)).encode('ASCII'), stdout=subprocess.PIPE)
-    img = Image.open(io.BytesIO(completed.stdout))
-    img = img.convert('RGBA')
-    newImage = []
-    for px in img.getdata():
-        if px[:3] == (255, 255, 255):
-            newImage.append((255, 255, 255, 0))
-        else:
-            newImage.append(px)
-    img.putdata(newImage)
+        return parse_statements(tokenize(read_chunks(f)))
+
+PLOTTER_UNITS_PER_MM = 40
+
+# RGB per pen, the same as `hp2xx -c 124111`: black, red, blue, then black
+PREVIEW_COLORS = {1: (0, 0, 0), 2: (255, 0, 0), 3: (0, 0, 255), 4: (0, 0, 0), 5: (0, 0, 0), 6: (0, 0, 0)}
+
+def preview_size(blocks: Iterable[Block], dpi=75) -> Tuple[int, int]:
+    """Pixel size of a preview running from the origin to the furthest move."""
+    scale = dpi / 25.4 / PLOTTER_UNITS_PER_MM
+    maxes = [b.coords.max(axis=0) for b in blocks if len(b.coords)]
+    if not maxes: return (1, 1)
+    width, height = np.maximum(np.max(maxes, axis=0), 0) * scale
+    return (int(math.ceil(width)) + 1, int(math.ceil(height)) + 1)
+
+def rasterize_preview(blocks: Iterable[Block], dpi=75, colors=PREVIEW_COLORS, size: Optional[Tuple[int, int]] = None, line_width=1) -> Image.Image:
+    """
+    Draws the pen-down moves of `blocks` on a transparent RGBA image, with
+    the plot origin in the bottom left corner like hp2xx. Pens missing from
+    `colors` draw black.
+    """
+    blocks = list(blocks)
+    if size is None:
+        size = preview_size(blocks, dpi)
+    scale = dpi / 25.4 / PLOTTER_UNITS_PER_MM
+    img = Image.new('RGBA', size, (255, 255, 255, 0))
+    draw = ImageDraw.Draw(img)
+    pen = None
+    position = None
+    for b in blocks:
+        if not len(b._commands): continue
+        pixels = b.coords * (scale, -scale) + (0, size[1] - 1)
+        for i, c in enumerate(b._commands):
+            start, stop = b._offsets[i], b._offsets[i + 1]
+            if c == 'SP':
+                pen = int(b._tails[i].split(',')[0] or 0)
+            elif c == 'PU' and stop > start:
+                position = pixels[stop - 1]
+            elif c == 'PD' and stop > start:
+                points = pixels[start:stop] if position is None else np.concatenate(([position], pixels[start:stop]))
+                color = colors.get(pen, (0, 0, 0)) + (255,)
+                if len(points) > 1:
+                    draw.line(points.ravel().tolist(), fill=color, width=line_width)
+                else:
+                    draw.point(points.ravel().tolist(), fill=color)
+                position = pixels[stop - 1]
     return img
 
+def composite_previews(images: Sequence[Image.Image], band=1024) -> Image.Image:
+    """
+    Lays RGBA previews over each other and over white, bottom left aligned,
+    first at the bottom. Works through `band` rows at a time to keep the
+    temporaries of big plots small.
+    """
+    width = max(i.size[0] for i in images)
+    height = max(i.size[1] for i in images)
+    out = np.full((height, width, 3), 255, dtype=np.uint8)
+    for img in images:
+        if img.mode != 'RGBA':
+            img = img.convert('RGBA')
+        bbox = img.getchannel('A').getbbox()
+        if not bbox: continue
+        layer = np.asarray(img.crop(bbox))
+        top = height - img.size[1] + bbox[1]
+        for row in range(0, layer.shape[0], band):
+            src = layer[row:row + band]
+            dst = out[top + row:top + row + len(src), bbox[0]:bbox[2]]
+            # previews are mostly empty, so only blend what's drawn
+            drawn = src[..., 3] != 0
+            pixels = src[drawn].astype(np.uint16)
+            alpha = pixels[:, 3:]
+            dst[drawn] = (pixels[:, :3] * alpha + dst[drawn] * (255 - alpha) + 127) // 255
+    return Image.fromarray(out, 'RGB')
+
+def _hp2xx_preview(commands, dpi=75) -> Image.Image:
+    completed = subprocess.run(['hp2xx', '-q', '-t', '-x', '0', '-y', '0', '-d', str(dpi), '-m', 'png', '-c', '124111', '-f', '-'], input="".join(map(str, commands)).encode('ASCII'), stdout=subprocess.PIPE)
+    img = np.array(Image.open(io.BytesIO(completed.stdout)).convert('RGBA'))
+    img[np.all(img[..., :3] == 255, axis=-1), 3] = 0
+    return Image.fromarray(img, 'RGBA')
+
+def render_preview(commands, outfile, dpi=75, renderer='native'):
+    image_preview(commands, dpi, renderer).save(outfile)
+
+def image_preview(commands, dpi=75, renderer='native') -> Image.Image:
+    """
+    Transparent preview of `commands` (a list of blocks). `renderer` is
+    'native', or 'hp2xx' to shell out to that instead for comparison.
+    """
+    if renderer == 'hp2xx':
+        return _hp2xx_preview(commands, dpi)
+    return rasterize_preview(commands, dpi)
 
 def show_preview(commands):
-    image_preview(commands, rewrite_color).show()
+    image_preview(commands).show()
+
+def snap_points(points: np.ndarray, tolerance=0.0) -> np.ndarray:
+    """
+    For each of `points`, the number of the earlier point it snaps to, or
+    its own. A point snaps to the first earlier one within `tolerance` that
+    didn't snap itself, the same as taking them one at a time; without a
+    tolerance, only to equal points.
+    """
+    count = len(points)
+    if not count: return np.empty(0, dtype=int)
+    if not tolerance:
+        # each point as one complex number, which sorts much faster than rows
+        keys = np.ascontiguousarray(points, dtype=np.float64).view(np.complex128).reshape(-1)
+        unique, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        return first[inverse]
+
+    # grid cells one tolerance across, numbered in one go; matches are in the cell or next to it
+    cells = np.floor(points / tolerance).astype(np.int64)
+    cells -= cells.min(axis=0) - 1
+    height = int(cells[:, 1].max()) + 2
+    keys = cells[:, 0] * height + cells[:, 1]
+    unique, inverse = np.unique(keys, return_inverse=True)
+    sizes = np.bincount(inverse, minlength=len(unique))
+    firsts = np.cumsum(sizes) - sizes
+    by_cell = np.argsort(inverse, kind='stable')
+    later, earlier = [], []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            # looked up per cell, in order, then handed out to the points in it
+            wanted = unique + dx * height + dy
+            cell = np.minimum(np.searchsorted(unique, wanted), len(unique) - 1)
+            cell = np.where(unique[cell] == wanted, cell, -1)[inverse]
+            found = np.flatnonzero(cell >= 0)
+            cell = cell[found]
+            n = sizes[cell]
+            members = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n) + np.repeat(firsts[cell], n)
+            later.append(np.repeat(found, n))
+            earlier.append(by_cell[members])
+    i, j = np.concatenate(later), np.concatenate(earlier)
+    keep = (j < i) & (np.hypot(*(points[i] - points[j]).T) <= tolerance)
+    i, j = i[keep], j[keep]
+
+    # a point keeps its own number if everything earlier in reach snapped, and
+    # snaps if anything earlier in reach didn't; the first undecided point is
+    # always decided next, so this settles
+    UNDECIDED, OWN, SNAPPED = 0, 1, 2
+    state = np.full(count, OWN, dtype=np.int8)
+    state[i] = UNDECIDED
+    while True:
+        undecided = state == UNDECIDED
+        if not undecided.any(): break
+        snaps = np.zeros(count, dtype=bool)
+        snaps[i[state[j] == OWN]] = True
+        waits = np.zeros(count, dtype=bool)
+        waits[i[state[j] == UNDECIDED]] = True
+        state[undecided & snaps] = SNAPPED
+        state[undecided & ~snaps & ~waits] = OWN
+
+    target = np.arange(count)
+    own = state[j] == OWN
+    np.minimum.at(target, i[own], j[own])
+    return target
+
 
 class CutJoiner:
-    def __init__(self):
-        self.ends = {}
-        self.rings = []
-    
+    """
+    Greedily joins open cut lines that share endpoints into longer chains.
+
+    Lines are taken in the order given. Each one joins whichever chain
+    currently ends at its start point (else its end point), oriented the way
+    `extend_line` would, and the result keeps extending until neither end
+    matches. At a junction of three or more lines, the first two to arrive
+    are joined; the point is then interior, so a third starts a new chain,
+    which a fourth may join.
+
+    Joins only link piece ends together. A terminal numbers a piece end,
+    `2 * piece` for its first vertex and `2 * piece + 1` for its last, and a
+    chain is the (first, last) pair of terminals it runs between.
+    Coordinates are assembled once per chain, when it closes or when the
+    open chains are read. Endpoints closer than `tolerance` are snapped to
+    the first one seen. `add_traces` takes a whole plot's lines at once and
+    snaps their endpoints in one go.
+    """
+
+    def __init__(self, tolerance=0.0):
+        self.tolerance = tolerance
+        self.pieces: List[np.ndarray] = []
+        # node and linked terminal (or -1) by terminal
+        self.terminal_nodes: List[int] = []
+        self.links: List[int] = []
+        self.nodes: List[Coord] = []
+        # filled in on first use after `add_traces` numbered the nodes in bulk
+        self.node_lookup: Optional[Dict[Any, Any]] = {}
+        self.ends: Dict[int, Tuple[int, int]] = {}
+        self.rings: List[shapely.geometry.LineString] = []
+
+    def _node(self, point: Coord) -> int:
+        if self.node_lookup is None:
+            nodes, self.nodes, self.node_lookup = self.nodes, [], {}
+            for p in nodes:
+                self._node(p)
+        if not self.tolerance:
+            node = self.node_lookup.get(point)
+            if node is None:
+                node = self.node_lookup[point] = len(self.nodes)
+                self.nodes.append(point)
+            return node
+
+        cx, cy = math.floor(point[0] / self.tolerance), math.floor(point[1] / self.tolerance)
+        matches = [n for x in (cx - 1, cx, cx + 1) for y in (cy - 1, cy, cy + 1)
+                   for n in self.node_lookup.get((x, y), ())
+                   if dist(point, self.nodes[n]) <= self.tolerance]
+        if matches:
+            return min(matches)
+        node = len(self.nodes)
+        self.node_lookup.setdefault((cx, cy), []).append(node)
+        self.nodes.append(point)
+        return node
+
+    def _join(self, line: Tuple[int, int], other: Tuple[int, int]) -> Tuple[int, int]:
+        node, links = self.terminal_nodes, self.links
+        (first, last), (other_first, other_last) = line, other
+        if node[last] == node[other_first]:
+            a, b, retval = last, other_first, (first, other_last)
+        elif node[other_last] == node[first]:
+            a, b, retval = other_last, first, (other_first, last)
+        elif node[first] == node[other_first]:
+            a, b, retval = first, other_first, (last, other_last)
+        else:
+            a, b, retval = last, other_last, (first, other_first)
+        links[a], links[b] = b, a
+        return retval
+
+    def chain_coords(self, chain: Tuple[int, int]) -> np.ndarray:
+        terminals = []
+        terminal, last = chain
+        while True:
+            terminals.append(terminal)
+            following = self.links[terminal ^ 1]
+            if terminal ^ 1 == last or following < 0:
+                break
+            terminal = following
+        pieces = [self.pieces[t // 2] if t % 2 == 0 else self.pieces[t // 2][::-1] for t in terminals]
+        retval = np.concatenate([pieces[0]] + [p[1:] for p in pieces[1:]])
+        # the ends of each piece, where it was snapped to its neighbours
+        joints = np.cumsum([0] + [len(p) - 1 for p in pieces])
+        nodes = [self.terminal_nodes[t] for t in terminals] + [self.terminal_nodes[terminals[-1] ^ 1]]
+        retval[joints] = [self.nodes[n] for n in nodes]
+        return retval
+
+    def _closed_ring(self, chain: Tuple[int, int]) -> Optional[shapely.geometry.LineString]:
+        if self.terminal_nodes[chain[0]] != self.terminal_nodes[chain[1]]:
+            return None
+        line = shapely.geometry.LineString(self.chain_coords(chain))
+        return line if line.is_ring else None
+
     def add_unconnected(self, line: shapely.geometry.LineString):
         if not line: 
             print("Ummm, that's not a line.")
             return
-
-        if line.is_ring:# and line.is_closed:
-            print("Inserted ring.")
-            self.rings.append(line)
-            return
-        
-        for c in (line.coords[0], line.coords[-1]):
-            if c in self.ends:
-                o = self.ends[c]
-                if c is o:
-                    print("Self intersection")
-                    continue
-                extended = extend_line(list(line.coords), list(o.coords))
-                merged_line = shapely.geometry.LineString(coordinates=extended)
-                start, end = o.coords[0], o.coords[-1]
-                if start in self.ends: del self.ends[start]
-                if end in self.ends: del self.ends[end]
-                self.add_unconnected(merged_line)
+        self.add_traces([shapely.get_coordinates(line)])
+
+    def add_traces(self, traces: Sequence[np.ndarray]):
+        """Add lines given as (N, 2) arrays, in order, like `add_unconnected` on each."""
+        traces = [t for t in traces if len(t) > 1]
+        if not traces: return
+        lengths = np.array([len(t) for t in traces])
+        lasts = np.cumsum(lengths) - 1
+        coords = np.concatenate(traces)
+        starts, ends = coords[lasts - lengths + 1], coords[lasts]
+
+        # only lines ending where they start can be rings
+        rings: List[Optional[shapely.geometry.LineString]] = [None] * len(traces)
+        closed = np.flatnonzero(np.all(starts == ends, axis=1))
+        if len(closed):
+            lines = shapely.linestrings(np.concatenate([traces[k] for k in closed]), indices=np.repeat(np.arange(len(closed)), lengths[closed]))
+            for k, line, ring in zip(closed.tolist(), lines, shapely.is_ring(lines)):
+                if ring:
+                    rings[k] = line
+        pieces = np.flatnonzero([r is None for r in rings])
+        points = np.stack((starts[pieces], ends[pieces]), axis=1).reshape(-1, 2)
+
+        if self.nodes:
+            numbers = [self._node(tuple(p)) for p in points.tolist()]
+        else:
+            target = snap_points(points, self.tolerance)
+            own = target == np.arange(len(points))
+            numbers = (np.cumsum(own) - 1)[target].tolist()
+            self.nodes = [tuple(p) for p in points[own].tolist()]
+            self.node_lookup = None
+
+        nodes = iter(numbers)
+        for trace, ring in zip(traces, rings):
+            if ring is not None:
+                self.rings.append(ring)
+            else:
+                self._add_piece(trace, next(nodes), next(nodes))
+
+    def _add_piece(self, coords: np.ndarray, start: int, end: int):
+        terminal = 2 * len(self.pieces)
+        self.pieces.append(coords)
+        self.terminal_nodes += (start, end)
+        self.links += (-1, -1)
+        chain = (terminal, terminal + 1)
+        if self.tolerance and start == end:
+            ring = self._closed_ring(chain)
+            if ring:
+                self.rings.append(ring)
                 return
-        
-        for c in (line.coords[0], line.coords[-1]):
-            self.ends[c] = line
-    
+
+        node, ends = self.terminal_nodes, self.ends
+        while True:
+            first, last = node[chain[0]], node[chain[1]]
+            other = ends.get(first)
+            if other is None:
+                other = ends.get(last)
+                if other is None: break
+            chain = self._join(chain, other)
+            ends.pop(node[other[0]], None)
+            ends.pop(node[other[1]], None)
+            if node[chain[0]] == node[chain[1]]:
+                ring = self._closed_ring(chain)
+                if ring:
+                    self.rings.append(ring)
+                    return
+
+        ends[node[chain[0]]] = chain
+        ends[node[chain[1]]] = chain
+
+    def get_open(self) -> List[shapely.geometry.LineString]:
+        # each chain is in `ends` under both its end nodes
+        return [shapely.geometry.LineString(self.chain_coords(c)) for c in dict.fromkeys(self.ends.values())]
+
     def get_cuts(self):
-        return chain(self.rings, self.ends.values())
+        return chain(self.rings, self.get_open())
     
     def get_unique(self):
-        seen = []
-        for l in self.get_cuts():
-            if l in seen: continue
-            seen.append(l)
-        return seen
+        return list(self.get_cuts())
 
 
+@hpgl_profile.timed('organize', blocks=lambda plot: plot.blocks)
+def organize_cuts(plot, tolerance=0.0, simplify=0.0):
+    cuts = [b for b in plot.blocks if b.get_pen() == 2 and b.trace_array() is not None and len(b.trace_array()) > 1]
+    print(f"Optimizing {len(cuts)} cut blocks.")
+    joiner = CutJoiner(tolerance)
+    joiner.add_traces([b.trace_array() for b in cuts])
 
-def organize_cuts(plot):
-    joiner = CutJoiner()
-    intake_count = 0
-    for b in plot.blocks[:]:
-        trace = b.linestring()
-        if trace and b.get_pen() == 2:
-            plot.blocks.remove(b)
-            joiner.add_unconnected(trace)
-            intake_count += 1
-    print(f"Optimizing {intake_count} cut blocks.")
-
+    joined = []
+    vertices_before = vertices_after = 0
     for r in joiner.rings:
-        plot.blocks.append(line_to_block(r))
+        joined.append(line_to_block(r, simplify=simplify))
+        vertices_before += len(r.coords)
+        vertices_after += len(joined[-1].coords)
     print(f"Added {len(joiner.rings)} rings.")
     
-    seen = []
-    for l in joiner.ends.values():
-        if l in seen: continue
-        seen.append(l)
-        plot.blocks.append(line_to_block(l))
-    print(f"Added {len(seen)} non-rings.")
-
+    non_rings = joiner.get_open()
+    for l in non_rings:
+        joined.append(line_to_block(l, simplify=simplify))
+        vertices_before += len(l.coords)
+        vertices_after += len(joined[-1].coords)
+    print(f"Added {len(non_rings)} non-rings.")
+    if simplify:
+        print(f"Simplified cuts from {vertices_before} to {vertices_after} vertices.")
+
+    # in one go, so a built spatial index is updated rather than thrown away
+    plot.change_blocks(cuts, joined)
     return plot
 
+
+def is_cut_block(b: Block) -> bool:
+    return b.get_pen() == 2 and bool(b.linestring())
+
+
+class CutOrganizer:
+    """
+    Keeps the `organize_cuts` result for a plot current as pens change.
+
+    Cut blocks are grouped into connected components over shared endpoints.
+    `update` re-joins only the components touching the changed blocks; the
+    rest keep their joined blocks. The source plot itself isn't modified.
+    `freeze` carries on from the result as the new source.
+    """
+
+    def __init__(self, source: HPGLPlot, tolerance=0.0, simplify=0.0):
+        self.source = source
+        self.tolerance = tolerance
+        self.simplify = simplify
+        self.component_of: Dict[Block, int] = {}
+        self.members: Dict[int, List[Block]] = {}
+        self.joined: Dict[int, List[Block]] = {}
+        self.next_component = 0
+        self.plot = HPGLPlot()
+        self.update(source.blocks)
+
+    def _collect(self, seeds: Iterable[Block], index: EndpointIndex) -> List[List[Block]]:
+        """Cut components reachable from `seeds`, dropping their stale joins."""
+        components = []
+        seen: Set[Block] = set()
+        for seed in seeds:
+            if seed in seen or not is_cut_block(seed): continue
+            seen.add(seed)
+            component, stack = [], [seed]
+            while stack:
+                b = stack.pop()
+                component.append(b)
+                for n in index.neighbours(b):
+                    if n not in seen and is_cut_block(n):
+                        seen.add(n)
+                        stack.append(n)
+            components.append(component)
+        return components
+
+    def _forget(self, b: Block) -> List[Block]:
+        c = self.component_of.pop(b, None)
+        if c is None: return []
+        self.joined.pop(c, None)
+        members = self.members.pop(c, [])
+        for m in members:
+            self.component_of.pop(m, None)
+        return members
+
+    @hpgl_profile.timed('organize', blocks=lambda plot: plot.blocks)
+    def update(self, changed: Iterable[Block], removed: Iterable[Block] = ()) -> HPGLPlot:
+        """Re-join around `changed` blocks, and around `removed` ones that have been taken out of the source."""
+        index = self.source.endpoint_index(self.tolerance)
+        seeds = list(changed)
+        for b in list(removed) + seeds:
+            seeds.extend(self._forget(b))
+        seeds = [b for b in seeds if b in index.order]
+
+        components = self._collect(seeds, index)
+        # a new cut can bridge into components that weren't seeded
+        for component in components:
+            for b in component:
+                self._forget(b)
+
+        intake_count = 0
+        vertices_before = vertices_after = 0
+        for component in components:
+            component.sort(key=index.order.__getitem__)
+            joiner = CutJoiner(self.tolerance)
+            joiner.add_traces([b.trace_array() for b in component])
+            c = self.next_component
+            self.next_component += 1
+            self.members[c] = component
+            self.joined[c] = []
+            for l in joiner.get_cuts():
+                self.joined[c].append(line_to_block(l, simplify=self.simplify))
+                vertices_before += len(l.coords)
+                vertices_after += len(self.joined[c][-1].coords)
+            for b in component:
+                self.component_of[b] = c
+            intake_count += len(component)
+        print(f"Re-joined {intake_count} cut blocks in {len(components)} components.")
+        if self.simplify:
+            print(f"Simplified them from {vertices_before} to {vertices_after} vertices.")
+
+        self.plot = HPGLPlot()
+        self.plot.blocks = [b for b in self.source.blocks if b not in self.component_of] + list(chain(*self.joined.values()))
+        self.plot.init_statements = dict(self.source.init_statements)
+        return self.plot
+
+    def components(self) -> List[Tuple[List[Block], List[Block]]]:
+        """Each group of joined source blocks and the blocks it was joined into, for `restore`."""
+        return [(self.members[c][:], self.joined[c][:]) for c in self.members]
+
+    @classmethod
+    def restore(cls, source: HPGLPlot, plot: HPGLPlot, components: Iterable[Tuple[List[Block], List[Block]]],
+                tolerance=0.0, simplify=0.0) -> 'CutOrganizer':
+        """
+        An organizer carrying on from `plot`, a result worked out for `source`
+        earlier, without joining anything again. `components` are as from
+        `components()`.
+        """
+        o = cls.__new__(cls)
+        o.source = source
+        o.tolerance = tolerance
+        o.simplify = simplify
+        o.component_of, o.members, o.joined = {}, {}, {}
+        for c, (members, joined) in enumerate(components):
+            o.members[c] = members
+            o.joined[c] = joined
+            for b in members:
+                o.component_of[b] = c
+        o.next_component = len(o.members)
+        o.plot = plot
+        return o
+
+    def freeze(self) -> 'CutOrganizer':
+        """
+        An organizer whose source is the current result, without joining
+        anything again: each component's open joined blocks stand in as its
+        members. Closed ones are left alone from then on, as they would be in
+        a plot loaded with them. The source's indexes move over to the new
+        one, so nothing is rebuilt either.
+        """
+        components = []
+        for joined in self.joined.values():
+            members = [b for b in joined if is_cut_block(b)]
+            if members:
+                components.append((members, members[:]))
+        plot = HPGLPlot()
+        plot.blocks = list(self.plot.blocks)
+        plot.init_statements = dict(self.plot.init_statements)
+        o = CutOrganizer.restore(self.plot, plot, components, self.tolerance, self.simplify)
+        o.source.take_indexes(self.source)
+        return o
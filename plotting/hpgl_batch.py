@@ -0,0 +1,127 @@
+"""
+Headless preprocessing: what `mark_cuts` writes, but with the cuts picked by
+rules instead of clicks, for whole directories of exports at once. Nothing
+here touches Kivy.
+"""
+
+import contextlib, io, os, os.path, re, time, traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import hpgl, hpgl_session, hpgl_text
+from typing import *
+
+STAGES = ('parse', 'mark', 'labels', 'organize', 'transform', 'write')
+
+
+def output_path(filename: str, out_dir: Optional[str] = None) -> str:
+    stem = os.path.splitext(filename)[0]
+    if out_dir:
+        stem = os.path.join(out_dir, os.path.basename(stem))
+    return stem + "-preprocessed.plt"
+
+
+def read_block_list(filename: str) -> Set[int]:
+    """
+    Block numbers (0-based, in file order) separated by commas or whitespace.
+    `a-b` includes both ends and `#` starts a comment.
+    """
+    numbers: Set[int] = set()
+    with open(filename) as f:
+        for line in f:
+            for item in re.split(r'[\s,]+', line.split('#', 1)[0].strip()):
+                if not item: continue
+                first, _, last = item.partition('-')
+                numbers.update(range(int(first), int(last or first) + 1))
+    return numbers
+
+
+class CutRules:
+    """
+    Which blocks get marked for cutting (pen 2). A block is marked if any rule
+    picks it: it's drawn with one of `pens`, it's `closed`, or its number is in
+    the block list. `block_list` is a filename with `{stem}` standing for the
+    plot's filename without extension, so each plot can have its own list;
+    plots without one just get the other rules. Blocks already on pen 2 stay
+    cuts either way.
+    """
+
+    def __init__(self, pens: Iterable[int] = (), closed=False, block_list: Optional[str] = None):
+        self.pens = set(pens)
+        self.closed = closed
+        self.block_list = block_list
+
+    def block_numbers(self, filename: str) -> Set[int]:
+        if not self.block_list: return set()
+        path = self.block_list.format(stem=os.path.splitext(filename)[0])
+        if path != self.block_list and not os.path.exists(path): return set()
+        return read_block_list(path)
+
+    def mark(self, plot: hpgl.HPGLPlot, filename: str) -> int:
+        numbers = self.block_numbers(filename)
+        marked = 0
+        for i, b in enumerate(plot.blocks):
+            if b.is_text() or not b.has_trace(): continue
+            if i in numbers or b.get_pen() in self.pens or (self.closed and b.is_closed()):
+                b.set_pen(2)
+                marked += 1
+        return marked
+
+
+def process_file(filename: str, rules: CutRules, fontname='courier', snap=0.0, simplify=0.0, out_dir: Optional[str] = None,
+                 placement: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Preprocess one plot and write it next to the original (or into `out_dir`).
+    `placement` holds `hpgl.placement_transform` arguments to move the result
+    with before writing. Never raises: failures come back in `error`, along with whatever the
+    stages printed in `log`.
+    """
+    result: Dict[str, Any] = {'file': filename, 'output': output_path(filename, out_dir), 'timings': {}, 'error': None}
+    timings = result['timings']
+    log = io.StringIO()
+
+    @contextlib.contextmanager
+    def stage(name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings[name] = time.perf_counter() - start
+
+    try:
+        with contextlib.redirect_stdout(log):
+            with stage('parse'):
+                plot = hpgl_session.load_plot(filename)
+            result['blocks'] = len(plot.blocks)
+            # block numbers refer to the file as exported, so mark before labels expand
+            with stage('mark'):
+                result['marked'] = rules.mark(plot, filename)
+            with stage('labels'):
+                result['labels'] = hpgl_text.rewrite_labels(plot, fontname)
+            with stage('organize'):
+                hpgl.organize_cuts(plot, snap, simplify)
+            result['cuts'] = sum(1 for b in plot.blocks if b.get_pen() in (2, 3) and b.has_trace())
+            if placement:
+                with stage('transform'):
+                    matrix = hpgl.placement_transform(plot.extents(), **placement)
+                    if not np.allclose(matrix, np.eye(3)):
+                        plot.transform(matrix)
+            with stage('write'):
+                hpgl.write_atomic(result['output'], hpgl.flatten_blocks_to_text(plot.blocks))
+                hpgl_session.save_session(result['output'], hpgl_session.Session(plot))
+    except Exception:
+        result['error'] = traceback.format_exc()
+    result['log'] = log.getvalue()
+    return result
+
+
+def run_batch(files: Iterable[str], rules: CutRules, jobs: Optional[int] = None, **options) -> Iterator[Dict[str, Any]]:
+    """`process_file` over `files` on a pool of `jobs` processes, yielding results as they finish."""
+    files = list(files)
+    if jobs == 1 or len(files) == 1:
+        for f in files:
+            yield process_file(f, rules, **options)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(process_file, f, rules, **options) for f in files]
+        for future in as_completed(futures):
+            yield future.result()
@@ -0,0 +1,163 @@
+"""
+Rough run time of a job before it's sent, from a motion model of the
+machine and the material being cut.
+
+The head is taken to accelerate and brake at a constant rate. It stops at
+both ends of every path and of every pen-up move, and slows down for
+corners: straight on it keeps going at full speed, a right angle halves it
+and a reversal stops it. Each pen-down/pen-up pair costs a fixed lift time.
+
+The figures come from `Key: value unit` lines in the notes under
+`machines/` (travel and draw speed, acceleration, pen lift) and `formulas/`
+(the speed the material is cut at).
+"""
+
+import os, os.path, re
+import numpy as np
+import hpgl
+from typing import *
+
+Coord = Tuple[float, float]
+
+NOTES_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_NOTE_VALUE = re.compile(r'\s*([A-Za-z][A-Za-z ]*?)\s*:\s*(-?[0-9]+(?:\.[0-9]*)?)\s*(\S*)\s*$')
+
+# note keys for each `MotionModel` setting, and which notes they're read from
+MACHINE_KEYS = {'travel speed': 'travel_speed', 'draw speed': 'draw_speed', 'acceleration': 'acceleration', 'pen lift': 'lift_time'}
+MATERIAL_KEYS = {'speed': 'cut_speed'}
+
+
+def note_path(name: str, kind: str) -> str:
+    """`name` if it's a file, otherwise the note of that name in the `kind` (`machines` or `formulas`) directory."""
+    if os.path.isfile(name):
+        return name
+    return os.path.join(NOTES_DIR, kind, name + ".md")
+
+
+def note_names(kind: str) -> List[str]:
+    directory = os.path.join(NOTES_DIR, kind)
+    if not os.path.isdir(directory): return []
+    return sorted(os.path.splitext(f)[0] for f in os.listdir(directory) if f.endswith(".md"))
+
+
+def read_note_values(filename: str) -> Dict[str, float]:
+    """The `Key: number unit` lines of a note, by lowercase key. Units are ignored."""
+    values = {}
+    with open(filename) as f:
+        for line in f:
+            m = _NOTE_VALUE.match(line)
+            if m:
+                values[m.group(1).lower()] = float(m.group(2))
+    return values
+
+
+def move_times(lengths: np.ndarray, entry: np.ndarray, exit: np.ndarray, speed: float, acceleration: float) -> np.ndarray:
+    """
+    Time for each straight move of `lengths` mm, starting at `entry` and
+    ending at `exit` mm/s, speeding up towards `speed` in between. The end
+    speeds have to be reachable from each other within the move.
+    """
+    ramp = (2 * speed ** 2 - entry ** 2 - exit ** 2) / (2 * acceleration)
+    cruising = lengths >= ramp
+    peak = np.where(cruising, speed, np.sqrt(np.maximum(acceleration * lengths + (entry ** 2 + exit ** 2) / 2, 0.0)))
+    times = (2 * peak - entry - exit) / acceleration
+    return times + np.where(cruising, (lengths - ramp) / speed, 0.0)
+
+
+class MotionModel:
+    """
+    Speeds are in mm/s, acceleration in mm/s² and the lift time in seconds.
+    The defaults are rough guesses; see `machines/titan3.md`.
+    """
+
+    def __init__(self, draw_speed=100.0, cut_speed=36.0, travel_speed=100.0, acceleration=1000.0, lift_time=0.1):
+        self.draw_speed = draw_speed
+        self.cut_speed = cut_speed
+        self.travel_speed = travel_speed
+        self.acceleration = acceleration
+        self.lift_time = lift_time
+
+    @classmethod
+    def from_notes(cls, machine: Optional[str] = None, material: Optional[str] = None) -> 'MotionModel':
+        """The model for a machine and material note, by name or path; missing notes and values keep the defaults."""
+        settings = {}
+        for name, kind, keys in ((machine, 'machines', MACHINE_KEYS), (material, 'formulas', MATERIAL_KEYS)):
+            if not name: continue
+            path = note_path(name, kind)
+            if not os.path.exists(path): continue
+            values = read_note_values(path)
+            settings.update((setting, values[key]) for key, setting in keys.items() if key in values)
+        return cls(**settings)
+
+    def __repr__(self):
+        return "MotionModel(draw_speed={}, cut_speed={}, travel_speed={}, acceleration={}, lift_time={})".format(
+            self.draw_speed, self.cut_speed, self.travel_speed, self.acceleration, self.lift_time)
+
+    def pen_down_time(self, traces: Sequence[np.ndarray], speed: float) -> Tuple[float, float]:
+        """Seconds and mm spent going along `traces` (in plotter units) at up to `speed`."""
+        traces = [t for t in traces if len(t) > 1]
+        if not traces: return 0.0, 0.0
+        coords = np.concatenate(traces) / hpgl.PLOTTER_UNITS_PER_MM
+        path = np.repeat(np.arange(len(traces)), [len(t) for t in traces])
+        steps = coords[1:] - coords[:-1]
+        lengths = np.hypot(steps[:, 0], steps[:, 1])
+        moving = (path[1:] == path[:-1]) & (lengths > 0)
+        steps, lengths, path = steps[moving], lengths[moving], path[1:][moving]
+        if not len(lengths): return 0.0, 0.0
+
+        # speed through the vertex between each move and the next one
+        units = steps / lengths[:, None]
+        turn = np.einsum('ij,ij->i', units[:-1], units[1:])
+        corner = speed * (1 + turn) / 2
+        corner = np.minimum(corner, np.sqrt(self.acceleration * np.minimum(lengths[:-1], lengths[1:])))
+        corner[path[1:] != path[:-1]] = 0.0
+        entry = np.concatenate([[0.0], corner])
+        exit = np.concatenate([corner, [0.0]])
+        # the first and last moves of each path still start and end stopped
+        entry = np.minimum(entry, np.sqrt(self.acceleration * lengths))
+        exit = np.minimum(exit, np.sqrt(self.acceleration * lengths))
+        return float(move_times(lengths, entry, exit, speed, self.acceleration).sum()), float(lengths.sum())
+
+    def pass_time(self, blocks: Iterable[hpgl.Block], speed: float, start: Coord = (0.0, 0.0)) -> Dict[str, Any]:
+        """Time for sending `blocks` as one pass at up to `speed`, broken down, and where it ends up."""
+        traces = []
+        for b in blocks:
+            trace = b.trace_array()
+            if trace is not None and len(trace):
+                traces.append(trace)
+        down_seconds, down_length = self.pen_down_time(traces, speed)
+        if traces:
+            starts = np.array([t[0] for t in traces])
+            ends = np.array([start] + [t[-1] for t in traces[:-1]])
+            gaps = np.hypot(*(starts - ends).T) / hpgl.PLOTTER_UNITS_PER_MM
+            zero = np.zeros(len(gaps))
+            travel_seconds = float(move_times(gaps, zero, zero, self.travel_speed, self.acceleration).sum())
+            travel_length = float(gaps.sum())
+            end = (float(traces[-1][-1][0]), float(traces[-1][-1][1]))
+        else:
+            travel_seconds = travel_length = 0.0
+            end = start
+        lift_seconds = len(traces) * self.lift_time
+        return {'seconds': down_seconds + travel_seconds + lift_seconds, 'down_seconds': down_seconds, 'travel_seconds': travel_seconds,
+                'lift_seconds': lift_seconds, 'down_mm': down_length, 'travel_mm': travel_length, 'lifts': len(traces),
+                'vertices': sum(len(t) for t in traces), 'end': end}
+
+    def estimate(self, passes: Dict[str, List[hpgl.Block]]) -> Dict[str, Dict[str, Any]]:
+        """
+        Times for the pen, label and knife passes from `HPGLPlot.find_passes()`,
+        sent the way `plotter_send` does: labels carry on from the pen pass and
+        the knife starts again from the origin.
+        """
+        pen = self.pass_time(passes['pen'], self.draw_speed)
+        labels = self.pass_time(passes['labels'], self.draw_speed, pen['end'])
+        knife = self.pass_time(passes['knife'], self.cut_speed)
+        return {'pen': pen, 'labels': labels, 'knife': knife}
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "{}h{:02d}m{:02d}s".format(hours, minutes, seconds)
+    return "{}m{:02d}s".format(minutes, seconds)
@@ -0,0 +1,169 @@
+"""
+Nesting: packing the pieces of several plots, or of several copies of one,
+across the roll into a single job.
+
+A piece is a closed cut (pen 3, as `organize_cuts` leaves rings) with
+everything drawn inside it: pen lines, labels, other cuts and rings nested
+in it. Blocks outside every ring go with the nearest one, and a plot without
+any rings is one piece. The blocks of a piece move together.
+
+Pieces are placed by their bounding boxes with a skyline packer. The roll
+runs along X and is `width` across in Y. Longest first, each piece goes
+wherever its far end comes out lowest along the roll, trying each allowed
+rotation.
+"""
+
+import numpy as np
+import shapely
+import hpgl, hpgl_overlap, hpgl_profile
+from typing import *
+
+# placements this close count as touching, in plotter units
+EPSILON = 1e-6
+
+
+class Piece:
+    """The blocks of one piece and the area inside its rings, if it has any."""
+
+    def __init__(self, blocks: List[hpgl.Block], outline: Optional[shapely.Geometry] = None):
+        self.blocks = blocks
+        self.outline = outline
+        hull = shapely.convex_hull(shapely.multipoints(np.concatenate([b.trace_array() for b in blocks])))
+        self.hull = shapely.get_coordinates(hull)
+        self.area = (outline if outline is not None else hull).area
+
+    def footprint(self, angle: float) -> Tuple[np.ndarray, float, float]:
+        """The matrix turning the piece `angle` degrees with its lower-left corner at the origin, and its size in X and Y then."""
+        m = hpgl.rotation(angle)
+        turned = self.hull @ m[:2, :2].T
+        (x0, y0), (x1, y1) = turned.min(axis=0).tolist(), turned.max(axis=0).tolist()
+        return hpgl.translation(-x0, -y0) @ m, x1 - x0, y1 - y0
+
+
+def find_pieces(plot: hpgl.HPGLPlot) -> List[Piece]:
+    """The pieces of `plot`, each with its blocks in plot order."""
+    blocks = [b for b in plot.blocks if b.trace_array() is not None and len(b.trace_array())]
+    ring_blocks = [i for i, b in enumerate(blocks) if b.get_pen() == 3 and b.is_closed() and len(b.trace_array()) > 3]
+    if not ring_blocks:
+        return [Piece(blocks)] if blocks else []
+
+    rings = [shapely.Polygon(blocks[i].trace_array()) for i in ring_blocks]
+    rings = [r if r.is_valid else shapely.make_valid(r) for r in rings]
+    # rings that cross or sit inside each other, like an allowance exported twice, are one piece
+    tree = shapely.STRtree(rings)
+    groups = hpgl_overlap.group_pairs(len(rings), *tree.query(rings, predicate='intersects'))
+    group_of = np.empty(len(rings), dtype=int)
+    for g, group in enumerate(groups):
+        group_of[group] = g
+
+    # everything else goes with a ring it's inside, or the nearest one
+    points = shapely.points([b.trace_array()[len(b.trace_array()) // 2] for b in blocks])
+    owner = np.full(len(blocks), -1)
+    inside, ring = tree.query(points, predicate='within')
+    owner[inside] = group_of[ring]
+    owner[ring_blocks] = group_of
+    loose = np.flatnonzero(owner < 0)
+    if len(loose):
+        which, nearest = tree.query_nearest(points[loose])
+        owner[loose[which]] = group_of[nearest]
+
+    members: List[List[hpgl.Block]] = [[] for g in groups]
+    for b, g in zip(blocks, owner.tolist()):
+        members[g].append(b)
+    return [Piece(members[g], shapely.union_all([rings[r] for r in group])) for g, group in enumerate(groups)]
+
+
+class Skyline:
+    """
+    How far along the roll it's filled so far, in steps across it: from
+    `starts[i]` up to the next start (or `width`) it's filled to
+    `heights[i]`.
+    """
+
+    def __init__(self, width: float):
+        self.width = width
+        self.starts = [0.0]
+        self.heights = [0.0]
+
+    def fit(self, size: float) -> Optional[Tuple[float, float]]:
+        """Where the lowest place `size` across is, as (across, along), or None if it's wider than the roll."""
+        best = None
+        ends = self.starts[1:] + [self.width]
+        for i, start in enumerate(self.starts):
+            if start + size > self.width + EPSILON: break
+            height, j = self.heights[i], i
+            while ends[j] < start + size - EPSILON:
+                j += 1
+                height = max(height, self.heights[j])
+            if best is None or height < best[1] - EPSILON:
+                best = (start, height)
+        return best
+
+    def place(self, start: float, size: float, height: float):
+        """Fill from `start` to `start + size` across, up to `height`."""
+        end = start + size
+        ends = self.starts[1:] + [self.width]
+        steps = [(s, h) for s, h in zip(self.starts, self.heights) if s < start - EPSILON]
+        steps.append((start, height))
+        steps += [(max(s, end), h) for s, e, h in zip(self.starts, ends, self.heights) if e > end + EPSILON]
+        self.starts, self.heights = [], []
+        for s, h in steps:
+            if self.heights and abs(self.heights[-1] - h) < EPSILON: continue
+            self.starts.append(s)
+            self.heights.append(h)
+
+
+def pack_pieces(pieces: Sequence[Piece], width: float, rotations: Sequence[float] = (0.0,), gap=0.0) -> List[Tuple[Piece, np.ndarray]]:
+    """
+    Where each piece goes, as the matrix moving it there, in the order placed.
+    Pieces are kept `gap` apart. Raises ValueError if one doesn't fit
+    across `width` at any of the `rotations`.
+    """
+    footprints = {id(p): [p.footprint(r) for r in rotations] for p in pieces}
+    # longest first, which packs tighter than biggest first
+    order = sorted(pieces, key=lambda p: -max(footprints[id(p)][0][1:]))
+    # every piece takes `gap` more room, and so does the roll for the last one across
+    skyline = Skyline(width + gap)
+    placed = []
+    for piece in order:
+        best = None
+        for matrix, length, across in footprints[id(piece)]:
+            spot = skyline.fit(across + gap)
+            if spot is None: continue
+            start, height = spot
+            key = (height + length, height, start)
+            if best is None or key < best[0]:
+                best = (key, matrix, length, across, start, height)
+        if best is None:
+            raise ValueError("A piece {:.0f} units across doesn't fit on a {:.0f} unit roll".format(
+                min(min(fx, fy) for m, fx, fy in footprints[id(piece)]), width))
+        key, matrix, length, across, start, height = best
+        skyline.place(start, across + gap, height + length + gap)
+        placed.append((piece, hpgl.translation(height, start) @ matrix))
+    return placed
+
+
+@hpgl_profile.timed('nest', blocks=lambda result: result[0].blocks)
+def nest_plots(plots: Sequence[hpgl.HPGLPlot], width: float, copies=1, rotations: Sequence[float] = (0.0,), gap=0.0) -> Tuple[hpgl.HPGLPlot, Dict[str, Any]]:
+    """
+    One job with `copies` of every piece of `plots`, packed `gap` apart
+    across `width` plotter units of roll from the origin along X. Returns
+    the job, which starts with the first plot's init block, and how much
+    roll it takes up.
+    """
+    pieces = [p for plot in plots for p in find_pieces(plot)]
+    placed = pack_pieces(pieces * copies, width, rotations, gap)
+    blocks = [plots[0].get_init_block().clone()]
+    for piece, matrix in placed:
+        part = hpgl.HPGLPlot()
+        part.blocks = [b.clone() for b in piece.blocks]
+        part.transform(matrix)
+        blocks += part.blocks
+    job = hpgl.HPGLPlot()
+    job.blocks = blocks
+    job.find_inits()
+
+    length = job.extents()[1][0] if placed else 0.0
+    area = sum(piece.area for piece, matrix in placed)
+    return job, {'pieces': len(placed), 'width': width, 'length': length, 'piece_area': area,
+                 'utilization': area / (width * length) if length else 0.0}
@@ -0,0 +1,209 @@
+"""
+Drops knife moves over lines that were already cut earlier in the pass, like
+seams shared by neighbouring pieces or outlines repeated under their
+allowances.
+
+Every segment of the pass is paired with the segments within the tolerance
+of it through an STRtree. Pairs that are collinear and overlap are grouped,
+and within a group each segment keeps only the spans that no earlier segment
+covered. Blocks that lose anything are split into new `SP`, `PU`, `PD`, `PU`
+blocks around the gaps; the rest are passed through untouched. Only blocks
+drawing one pen-down path are looked at, so a pen-up hop inside a block
+never becomes a cut.
+"""
+
+import math
+import numpy as np
+import shapely
+import hpgl, hpgl_profile
+from typing import *
+
+# pieces shorter than this many tolerances aren't worth putting the knife down for
+MIN_PIECE = 1.0
+
+
+def pass_segments(blocks: Sequence[hpgl.Block]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Start and end points of every non-zero move in `blocks`, in pass order,
+    and the block each belongs to. Blocks with pen-up moves inside them are
+    left out.
+    """
+    starts, ends, owners = [], [], []
+    for i, b in enumerate(blocks):
+        trace = b.trace_array()
+        if trace is None or len(trace) < 2 or not b.is_reorientable(): continue
+        starts.append(trace[:-1])
+        ends.append(trace[1:])
+        owners.append(np.full(len(trace) - 1, i))
+    if not starts:
+        return np.empty((0, 2)), np.empty((0, 2)), np.empty(0, dtype=int)
+    starts, ends, owners = np.concatenate(starts), np.concatenate(ends), np.concatenate(owners)
+    moving = np.any(starts != ends, axis=1)
+    return starts[moving], ends[moving], owners[moving]
+
+
+def overlapping_pairs(starts: np.ndarray, ends: np.ndarray, tolerance: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Pairs of segments `a < b` lying along the same line, within `tolerance`, for longer than `tolerance`."""
+    # boxes grown by the tolerance; the tree only compares their envelopes
+    lo, hi = np.minimum(starts, ends) - tolerance, np.maximum(starts, ends) + tolerance
+    tree = shapely.STRtree(shapely.box(lo[:, 0], lo[:, 1], hi[:, 0], hi[:, 1]))
+    a, b = tree.query(tree.geometries)
+    keep = a < b
+    a, b = a[keep], b[keep]
+
+    direction = ends - starts
+    length = np.hypot(*direction.T)
+    unit = direction / length[:, None]
+
+    def off_line(line, points):
+        offset = points - starts[line]
+        return np.abs(unit[line, 0] * offset[:, 1] - unit[line, 1] * offset[:, 0])
+
+    collinear = ((off_line(a, starts[b]) <= tolerance) & (off_line(a, ends[b]) <= tolerance)
+                 & (off_line(b, starts[a]) <= tolerance) & (off_line(b, ends[a]) <= tolerance))
+    a, b = a[collinear], b[collinear]
+    tb0 = np.einsum('ij,ij->i', starts[b] - starts[a], unit[a])
+    tb1 = np.einsum('ij,ij->i', ends[b] - starts[a], unit[a])
+    overlap = np.minimum(np.maximum(tb0, tb1), length[a]) - np.maximum(np.minimum(tb0, tb1), 0.0)
+    keep = overlap > tolerance
+    return a[keep], b[keep]
+
+
+def group_pairs(count: int, a: np.ndarray, b: np.ndarray) -> List[List[int]]:
+    """Connected groups of segments, each in pass order, leaving out segments without a pair."""
+    parent = list(range(count))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in zip(a.tolist(), b.tolist()):
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+    groups: Dict[int, List[int]] = {}
+    for i in sorted(set(a.tolist()) | set(b.tolist())):
+        groups.setdefault(find(i), []).append(i)
+    return list(groups.values())
+
+
+def subtract_intervals(lo: float, hi: float, covered: List[Tuple[float, float]]) -> List[Tuple[float, float]]:
+    """Parts of `[lo, hi]` outside the sorted, disjoint `covered` intervals."""
+    left = []
+    for c0, c1 in covered:
+        if c1 <= lo: continue
+        if c0 >= hi: break
+        if c0 > lo:
+            left.append((lo, c0))
+        lo = max(lo, c1)
+    if lo < hi:
+        left.append((lo, hi))
+    return left
+
+
+def add_interval(lo: float, hi: float, covered: List[Tuple[float, float]]) -> List[Tuple[float, float]]:
+    merged = []
+    for c0, c1 in sorted(covered + [(lo, hi)]):
+        if merged and c0 <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], c1))
+        else:
+            merged.append((c0, c1))
+    return merged
+
+
+def surviving_spans(starts: np.ndarray, ends: np.ndarray, groups: List[List[int]], tolerance: float) -> Dict[int, List[Tuple[float, float]]]:
+    """
+    For each segment that overlaps an earlier one, the fractions of it (from
+    its start towards its end) that still need cutting.
+    """
+    spans = {}
+    for group in groups:
+        origin = starts[group[0]]
+        axis = ends[group[0]] - origin
+        axis = axis / math.hypot(*axis)
+        covered: List[Tuple[float, float]] = []
+        for s in group:
+            t0, t1 = float(np.dot(starts[s] - origin, axis)), float(np.dot(ends[s] - origin, axis))
+            lo, hi = min(t0, t1), max(t0, t1)
+            if covered:
+                pieces = [(p0, p1) for p0, p1 in subtract_intervals(lo, hi, covered) if p1 - p0 > tolerance * MIN_PIECE]
+                if pieces != [(lo, hi)]:
+                    fractions = [((p0 - t0) / (t1 - t0), (p1 - t0) / (t1 - t0)) for p0, p1 in pieces]
+                    spans[s] = sorted((min(f), max(f)) for f in fractions)
+            covered = add_interval(lo, hi, covered)
+    return spans
+
+
+def split_block(block: hpgl.Block, first: int, cut: List[int], spans: Dict[int, List[Tuple[float, float]]]) -> List[hpgl.Block]:
+    """
+    `block`, whose moves are segments `first`... onwards, redrawn as paths
+    around what was dropped from the moves numbered (from 0) in `cut`.
+    """
+    trace = block.trace_array()
+    moves = np.flatnonzero(np.any(trace[1:] != trace[:-1], axis=1))
+    paths, current = [], []
+
+    def flush():
+        if sum(len(c) for c in current) > 1:
+            paths.append(np.concatenate(current))
+        current.clear()
+
+    def untouched(start, stop):
+        if start >= stop: return
+        if not current:
+            current.append(trace[moves[start]][None])
+        current.append(trace[moves[start:stop] + 1])
+
+    done = 0
+    for k in cut:
+        untouched(done, k)
+        p0, p1 = trace[moves[k]], trace[moves[k] + 1]
+        kept = spans[first + k]
+        for f0, f1 in kept:
+            if f0 > 0 or not current:
+                flush()
+                current.append((p0 + (p1 - p0) * f0)[None])
+            current.append((p0 + (p1 - p0) * f1)[None])
+        if not kept or kept[-1][1] < 1:
+            flush()
+        done = k + 1
+    untouched(done, len(moves))
+    flush()
+
+    pen = block.get_pen()
+    blocks = []
+    for path in paths:
+        closed = np.array_equal(path[0], path[-1])
+        blocks.append(hpgl.coords_to_block(path, (3 if closed else 2) if pen in (2, 3) else pen))
+    return blocks
+
+
+@hpgl_profile.timed('overlaps', blocks=lambda result: result[0])
+def remove_overlaps(blocks: Sequence[hpgl.Block], tolerance=1.0) -> Tuple[List[hpgl.Block], float]:
+    """
+    `blocks` without the moves that go back over a line already cut, to
+    within `tolerance` plotter units. Returns the new blocks and the cut
+    length removed.
+    """
+    starts, ends, owners = pass_segments(blocks)
+    if not len(starts): return list(blocks), 0.0
+    a, b = overlapping_pairs(starts, ends, tolerance)
+    spans = surviving_spans(starts, ends, group_pairs(len(starts), a, b), tolerance)
+    if not spans: return list(blocks), 0.0
+
+    lengths = np.hypot(*(ends - starts).T)
+    removed = sum(lengths[s] * (1.0 - sum(f1 - f0 for f0, f1 in kept)) for s, kept in spans.items())
+    first_segment = np.searchsorted(owners, np.arange(len(blocks)))
+    cut: Dict[int, List[int]] = {}
+    for s in sorted(spans):
+        owner = int(owners[s])
+        cut.setdefault(owner, []).append(s - int(first_segment[owner]))
+    result = []
+    for i, block in enumerate(blocks):
+        if i in cut:
+            result.extend(split_block(block, int(first_segment[i]), cut[i], spans))
+        else:
+            result.append(block)
+    return result, float(removed)
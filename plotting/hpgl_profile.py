@@ -0,0 +1,114 @@
+"""
+Per-stage timings behind the `--profile` options.
+
+Library code marks its stages with `stage()`. Nothing is recorded until a
+command calls `enable()`, so the stages cost next to nothing otherwise.
+Each finished stage is a dict of its name, nesting depth, wall time and
+whatever counts were filled in (`blocks`, `vertices`, `bytes`), and `dump()`
+writes them all out as JSON.
+"""
+
+import contextlib, functools, json, sys, threading, time
+from typing import *
+
+_profile: Optional['Profile'] = None
+
+
+class Profile:
+    def __init__(self, **info):
+        self.info = info
+        self.stages: List[Dict[str, Any]] = []
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def stage(self, name: str, **counts):
+        depth = getattr(self.local, 'depth', 0)
+        record = {'stage': name, 'depth': depth, 'start': time.perf_counter() - self.started}
+        record.update(counts)
+        self.local.depth = depth + 1
+        try:
+            yield record
+        finally:
+            self.local.depth = depth
+            record['seconds'] = time.perf_counter() - self.started - record['start']
+            with self.lock:
+                self.stages.append(record)
+
+    def report(self) -> Dict[str, Any]:
+        with self.lock:
+            stages = sorted(self.stages, key=lambda r: r['start'])
+        totals: Dict[str, float] = {}
+        for r in stages:
+            if r['depth'] == 0:
+                totals[r['stage']] = totals.get(r['stage'], 0.0) + r['seconds']
+        return dict(self.info, seconds=time.perf_counter() - self.started, totals=totals, stages=stages)
+
+
+def enable(**info) -> Profile:
+    """Start recording stages; `info` goes at the top of the report."""
+    global _profile
+    _profile = Profile(**info)
+    return _profile
+
+
+def enabled() -> bool:
+    return _profile is not None
+
+
+def stage(name: str, **counts):
+    """
+    Context manager timing one stage. It yields the stage's record, so counts
+    known only at the end can be filled in with `count`.
+    """
+    if _profile is None:
+        return contextlib.nullcontext({})
+    return _profile.stage(name, **counts)
+
+
+def count(record: Dict[str, Any], blocks: Optional[Iterable[Any]] = None, **counts):
+    """Add `counts` to a stage record, and the block and vertex counts of `blocks`, if profiling."""
+    if _profile is None: return
+    if blocks is not None:
+        blocks = list(blocks)
+        record['blocks'] = len(blocks)
+        record['vertices'] = sum(len(b.coords) for b in blocks)
+    record.update(counts)
+
+
+def timed(name: str, blocks: Optional[Callable[[Any], Iterable[Any]]] = None, size: Optional[Callable[[Any], int]] = None):
+    """
+    Decorator running a function as a stage. `blocks` and `size` pick the
+    blocks to count and the bytes written out of its result.
+    """
+    def decorate(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if _profile is None:
+                return f(*args, **kwargs)
+            with stage(name) as record:
+                result = f(*args, **kwargs)
+                count(record, blocks(result) if blocks else None)
+                if size:
+                    record['bytes'] = size(result)
+            return result
+        return wrapper
+    return decorate
+
+
+def add(key: str, value: Any):
+    """Put `value` at the top of the report, e.g. a job time estimate."""
+    if _profile is not None:
+        _profile.info[key] = value
+
+
+def dump(filename: Optional[str] = None):
+    """Write the report as JSON to `filename`, or stderr for `-`."""
+    if _profile is None or not filename: return
+    text = json.dumps(_profile.report(), indent=1)
+    if filename == '-':
+        print(text, file=sys.stderr)
+    else:
+        with open(filename, 'w') as f:
+            f.write(text + "\n")
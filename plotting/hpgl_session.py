@@ -0,0 +1,165 @@
+"""
+Session files: a plot packed into arrays next to its `.plt`, so it loads
+again without parsing, along with the marking state `mark_cuts` had when it
+wrote it.
+
+The session of `pattern.plt` is `pattern.plt.session`. It starts with
+`MAGIC`, the length of a JSON header and the header itself, which lists the
+arrays that follow and where they are. Each array starts on an `ALIGN`
+boundary, so they're used straight from a memory map. The header also
+records the size and mtime of the `.plt` it was written alongside; once the
+`.plt` changes, the session is ignored and the text is parsed instead.
+
+Blocks are stored once, in one table for the plot and for the `source` it
+was organized from, with `pack_blocks`. The plot, the source and each
+component (which source blocks were joined into which plot blocks) are
+lists of numbers into that table.
+"""
+
+import json, mmap, os, os.path
+import numpy as np
+import hpgl, hpgl_profile
+from typing import *
+
+SESSION_SUFFIX = '.session'
+MAGIC = b'HPGLSESS'
+# bump when the layout changes, to ignore old session files
+SESSION_VERSION = 1
+ALIGN = 64
+
+
+def session_path(filename: str) -> str:
+    return filename + SESSION_SUFFIX
+
+
+def file_stamp(filename: str) -> List[int]:
+    """The size and mtime of `filename`, to tell whether it has changed since."""
+    st = os.stat(filename)
+    return [st.st_size, st.st_mtime_ns]
+
+
+class Session:
+    """
+    A plot, and if it came out of `mark_cuts` the marking state behind it:
+    the `source` plot with labels expanded and cuts marked but not joined,
+    and `components` pairing groups of source cut blocks with the plot blocks
+    they were joined into. `info` is whatever else the writer wanted kept,
+    like the file the source was read from.
+    """
+
+    def __init__(self, plot: hpgl.HPGLPlot, source: Optional[hpgl.HPGLPlot] = None,
+                 components: Iterable[Tuple[List[hpgl.Block], List[hpgl.Block]]] = (), tolerance=0.0, simplify=0.0, **info):
+        self.plot = plot
+        self.source = source
+        self.components = list(components)
+        self.tolerance = tolerance
+        self.simplify = simplify
+        self.info = info
+
+    @classmethod
+    def capture(cls, organizer: hpgl.CutOrganizer, **info) -> 'Session':
+        """The state of `organizer` as it is now. Edits swap blocks rather than change them, so this stays put."""
+        plot, source = hpgl.HPGLPlot(), hpgl.HPGLPlot()
+        plot.blocks, plot.init_statements = list(organizer.plot.blocks), dict(organizer.plot.init_statements)
+        source.blocks, source.init_statements = list(organizer.source.blocks), dict(organizer.source.init_statements)
+        return cls(plot, source, organizer.components(), organizer.tolerance, organizer.simplify, **info)
+
+    def organizer(self, tolerance=0.0, simplify=0.0) -> hpgl.CutOrganizer:
+        """An organizer for the source, only joining again if the joins were made with other settings."""
+        if self.source is None:
+            raise ValueError("Session has no marking state")
+        if (tolerance, simplify) != (self.tolerance, self.simplify):
+            return hpgl.CutOrganizer(self.source, tolerance, simplify)
+        return hpgl.CutOrganizer.restore(self.source, self.plot, self.components, tolerance, simplify)
+
+
+def _init_positions(plot: hpgl.HPGLPlot, numbers: Dict[hpgl.Block, int]) -> List[Tuple[str, int, int]]:
+    return [(command, numbers[s.block], s.index) for command, s in plot.init_statements.items() if s.block in numbers]
+
+
+def save_session(filename: str, session: Session):
+    """Write the session for `filename`, which should already hold the plot's text."""
+    blocks = list(session.source.blocks) if session.source is not None else []
+    numbers = {b: i for i, b in enumerate(blocks)}
+    for b in session.plot.blocks:
+        if b not in numbers:
+            numbers[b] = len(blocks)
+            blocks.append(b)
+
+    def block_numbers(blocks):
+        return np.array([numbers[b] for b in blocks], dtype=np.int64)
+
+    commands, arrays = hpgl.pack_blocks(blocks)
+    arrays['plot'] = block_numbers(session.plot.blocks)
+    inits = {'plot': _init_positions(session.plot, numbers)}
+    if session.source is not None:
+        arrays['source'] = block_numbers(session.source.blocks)
+        inits['source'] = _init_positions(session.source, numbers)
+        arrays['members'] = block_numbers(b for members, joined in session.components for b in members)
+        arrays['member_counts'] = np.array([len(members) for members, joined in session.components], dtype=np.int64)
+        arrays['joined'] = block_numbers(b for members, joined in session.components for b in joined)
+        arrays['joined_counts'] = np.array([len(joined) for members, joined in session.components], dtype=np.int64)
+
+    header = {'version': SESSION_VERSION, 'stamp': file_stamp(filename), 'commands': commands, 'inits': inits,
+              'marking': session.source is not None, 'tolerance': session.tolerance, 'simplify': session.simplify,
+              'info': session.info, 'arrays': {}}
+    chunks, offset = [], 0
+    for name, a in arrays.items():
+        data = np.ascontiguousarray(a).tobytes()
+        header['arrays'][name] = (a.dtype.str, a.shape, offset)
+        chunks += [data, bytes(-len(data) % ALIGN)]
+        offset += len(data) + len(chunks[-1])
+    text = json.dumps(header).encode('utf-8')
+    start = len(MAGIC) + 8 + len(text)
+    hpgl.write_atomic(session_path(filename), b"".join([MAGIC, len(text).to_bytes(8, 'little'), text, bytes(-start % ALIGN)] + chunks))
+
+
+def _read_session(filename: str) -> Optional[Tuple[Dict[str, Any], Dict[str, np.ndarray]]]:
+    """The header and memory-mapped arrays of the session for `filename`, if it was written for the file as it is."""
+    try:
+        with open(session_path(filename), 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        start = len(MAGIC) + 8
+        if data[:len(MAGIC)] != MAGIC: return None
+        end = start + int.from_bytes(data[len(MAGIC):start], 'little')
+        header = json.loads(data[start:end].decode('utf-8'))
+        if header.get('version') != SESSION_VERSION or header.get('stamp') != file_stamp(filename): return None
+        base = end + (-end % ALIGN)
+        arrays = {}
+        for name, (dtype, shape, offset) in header['arrays'].items():
+            count = int(np.prod(shape))
+            arrays[name] = np.frombuffer(data, dtype, count, base + offset).reshape(shape) if count else np.empty(shape, dtype)
+    except (OSError, ValueError, KeyError):
+        return None
+    return header, arrays
+
+
+@hpgl_profile.timed('session', blocks=lambda session: session.plot.blocks if session else None)
+def load_session(filename: str) -> Optional[Session]:
+    """The session saved alongside `filename`, or None if there isn't one for it as it is now."""
+    read = _read_session(filename)
+    if read is None: return None
+    header, arrays = read
+    blocks = hpgl.unpack_blocks(header['commands'], arrays)
+
+    def plot_of(name):
+        plot = hpgl.HPGLPlot()
+        plot.blocks = [blocks[i] for i in arrays[name].tolist()]
+        for command, block, index in header['inits'][name]:
+            plot.init_statements[command] = hpgl.Statement.view(blocks[block], index)
+        return plot
+
+    def groups(name, counts):
+        numbers = iter(arrays[name].tolist())
+        return [[blocks[next(numbers)] for i in range(count)] for count in arrays[counts].tolist()]
+
+    if not header['marking']:
+        return Session(plot_of('plot'), **header['info'])
+    components = zip(groups('members', 'member_counts'), groups('joined', 'joined_counts'))
+    return Session(plot_of('plot'), plot_of('source'), components, header['tolerance'], header['simplify'], **header['info'])
+
+
+def load_plot(filename: str) -> hpgl.HPGLPlot:
+    """The plot in `filename`, from its session if that's current, otherwise parsed from the text."""
+    session = load_session(filename)
+    return session.plot if session is not None else hpgl.parse_file(filename)
@@ -0,0 +1,395 @@
+"""
+Streams plotter passes to a port a chunk at a time, with flow control and
+progress reporting.
+
+The sender honours XON/XOFF sent back by the plotter, or the CTS line when
+using hardware handshake, and can also ask the plotter how much buffer space
+it has left (`ESC.B`) before every chunk. `SimulatedPlotter` pretends to be a
+slow plotter on a pty, for trying all of that out without the real thing.
+"""
+
+import os, sys, time, select, errno, threading, struct, fcntl, termios, tty, pty
+import hpgl
+from typing import *
+
+XON, XOFF = 0x11, 0x13
+BUFFER_QUERY = b'\x1b.B'
+HANDSHAKES = ('xonxoff', 'hardware', 'none')
+
+
+def split_statements(text: bytes, size: int) -> Iterator[bytes]:
+    """Splits `text` into pieces no longer than `size`, preferably just after a `;`."""
+    start = 0
+    while len(text) - start > size:
+        cut = text.rfind(b';', start, start + size) + 1
+        if cut <= start:
+            cut = start + size
+        yield text[start:cut]
+        start = cut
+    yield text[start:]
+
+
+def encode_chunks(texts: Iterable[bytes], chunk_size=512) -> Iterator[Tuple[bytes, int]]:
+    """
+    Packs encoded blocks into chunks of at most `chunk_size` bytes. Yields
+    (data, blocks finished by this chunk). Blocks too big for a chunk are
+    split between statements.
+    """
+    pending: List[bytes] = []
+    pending_len = 0
+    finished = 0
+    for text in texts:
+        if pending and pending_len + len(text) > chunk_size:
+            yield b''.join(pending), finished
+            pending, pending_len, finished = [], 0, 0
+        if len(text) > chunk_size:
+            pieces = list(split_statements(text, chunk_size))
+            for piece in pieces[:-1]:
+                yield piece, 0
+            text = pieces[-1]
+        pending.append(text)
+        pending_len += len(text)
+        finished += 1
+    if pending:
+        yield b''.join(pending), finished
+
+
+class FilePort:
+    """A device file, pty or pipe. Reads are optional and never block for long."""
+
+    def __init__(self, fd: int, readable=True, owned=True):
+        self.fd = fd
+        self.readable = readable
+        self.owned = owned
+
+    @classmethod
+    def open(cls, path: str) -> 'FilePort':
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_NOCTTY)
+            readable = True
+        except OSError:
+            fd = os.open(path, os.O_WRONLY)
+            readable = False
+        if os.isatty(fd):
+            # XON/XOFF and everything else should reach us untouched
+            tty.setraw(fd)
+        return cls(fd, readable)
+
+    def write(self, data: bytes):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view):]
+
+    def read(self, timeout=0.0) -> bytes:
+        if not self.readable:
+            time.sleep(timeout)
+            return b''
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return b''
+        try:
+            return os.read(self.fd, 4096)
+        except OSError as e:
+            if e.errno != errno.EIO: raise
+            return b''  # the other end of a pty went away
+
+    def clear_to_send(self) -> bool:
+        try:
+            status = struct.unpack('i', fcntl.ioctl(self.fd, termios.TIOCMGET, struct.pack('i', 0)))[0]
+        except OSError:
+            return True  # not a serial line, nothing to wait for
+        return bool(status & termios.TIOCM_CTS)
+
+    def flush(self):
+        if os.isatty(self.fd):
+            termios.tcdrain(self.fd)
+
+    def close(self):
+        if self.owned:
+            os.close(self.fd)
+
+
+class SerialPort:
+    """Adapts a `serial.Serial` to the port interface the sender uses."""
+
+    def __init__(self, serial_port):
+        self.serial = serial_port
+
+    def write(self, data: bytes):
+        self.serial.write(data)
+
+    def read(self, timeout=0.0) -> bytes:
+        self.serial.timeout = timeout
+        return self.serial.read(max(1, self.serial.in_waiting))
+
+    def clear_to_send(self) -> bool:
+        return self.serial.cts
+
+    def flush(self):
+        self.serial.flush()
+
+    def close(self):
+        self.serial.close()
+
+
+class Progress:
+    """Bytes and blocks sent so far, with throughput and an ETA."""
+
+    def __init__(self, total_bytes: int, total_blocks: int):
+        self.total_bytes = total_bytes
+        self.total_blocks = total_blocks
+        self.bytes = 0
+        self.blocks = 0
+        self.start = time.monotonic()
+        self.end: Optional[float] = None
+
+    def update(self, nbytes: int, nblocks: int):
+        self.bytes += nbytes
+        self.blocks += nblocks
+
+    def finish(self):
+        self.end = time.monotonic()
+
+    def elapsed(self) -> float:
+        return (self.end or time.monotonic()) - self.start
+
+    def rate(self) -> float:
+        elapsed = self.elapsed()
+        return self.bytes / elapsed if elapsed > 0 else 0.0
+
+    def eta(self) -> Optional[float]:
+        rate = self.rate()
+        return (self.total_bytes - self.bytes) / rate if rate else None
+
+    def __str__(self):
+        eta = self.eta()
+        eta = "{}:{:02d}".format(*divmod(int(eta), 60)) if eta is not None else "?:??"
+        percent = self.bytes / self.total_bytes if self.total_bytes else 1.0
+        return "{:6.1%}  {}/{} blocks  {:.0f} B/s  ETA {}".format(percent, self.blocks, self.total_blocks, self.rate(), eta)
+
+
+class StreamSender:
+    """
+    Sends blocks to `port` in chunks of at most `chunk_size` bytes, waiting
+    between chunks whenever the plotter asks it to. Given the `line_rate` in
+    bytes per second, it also paces itself to the line, for ports (ptys,
+    USB) whose `flush` can't wait for the data to actually leave. `on_progress` is called
+    with the `Progress` at most every `report_interval` seconds, and once more
+    at the end.
+    """
+
+    def __init__(self, port, handshake='xonxoff', poll_buffer=False, chunk_size=256, line_rate: Optional[float] = None, timeout=60.0,
+                 on_progress: Optional[Callable[[Progress], None]] = None, report_interval=0.5):
+        if handshake not in HANDSHAKES:
+            raise ValueError("Unknown handshake: " + handshake)
+        self.port = port
+        self.handshake = handshake
+        self.poll_buffer = poll_buffer
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.on_progress = on_progress
+        self.report_interval = report_interval
+        self.paused = False
+        self.response = bytearray()
+        self.buffer_free: Optional[int] = None
+        self.line_rate = line_rate
+        self.line_free_at = 0.0
+
+    def _read_input(self, timeout=0.0):
+        data = self.port.read(timeout)
+        for c in data:
+            if self.handshake == 'xonxoff' and c in (XON, XOFF):
+                self.paused = c == XOFF
+            else:
+                self.response.append(c)
+
+    def query_buffer(self, timeout=1.0) -> Optional[int]:
+        """Asks for free buffer space, or returns None if the plotter doesn't answer."""
+        self.response.clear()
+        self.port.write(BUFFER_QUERY)
+        deadline = time.monotonic() + timeout
+        while b'\r' not in self.response:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            self._read_input(min(remaining, 0.05))
+        answer = bytes(self.response[:self.response.index(b'\r')])
+        self.response.clear()
+        try:
+            return int(answer.strip())
+        except ValueError:
+            return None
+
+    def _ready(self, size: int) -> bool:
+        if self.paused: return False
+        if time.monotonic() < self.line_free_at: return False
+        if self.handshake == 'hardware' and not self.port.clear_to_send(): return False
+        if self.poll_buffer and (self.buffer_free is None or self.buffer_free < size):
+            self.buffer_free = self.query_buffer()
+            if self.buffer_free is None:
+                print("Plotter did not answer the buffer query; relying on handshake alone.", file=sys.stderr)
+                self.poll_buffer = False
+                return True
+            return self.buffer_free >= size
+        return True
+
+    def _wait(self, size: int):
+        deadline = time.monotonic() + self.timeout
+        self._read_input()
+        while not self._ready(size):
+            if time.monotonic() > deadline:
+                raise TimeoutError("Plotter has not accepted data for {} seconds.".format(self.timeout))
+            # don't oversleep when all we're waiting for is the line
+            wait = self.line_free_at - time.monotonic() if not self.paused else 0.05
+            self._read_input(min(wait, 0.05) if wait > 0 else 0.05)
+
+    def send(self, blocks: Iterable[hpgl.Block], encode: Callable[[hpgl.Block], str] = str) -> Progress:
+        texts = [encode(b).encode('ASCII') for b in blocks]
+        progress = Progress(sum(map(len, texts)), len(texts))
+
+        chunk_size = self.chunk_size
+        if self.poll_buffer:
+            # an empty plotter tells us its whole buffer; chunks must fit in it
+            self.buffer_free = self.query_buffer()
+            if self.buffer_free is None:
+                print("Plotter did not answer the buffer query; relying on handshake alone.", file=sys.stderr)
+                self.poll_buffer = False
+            elif self.buffer_free > 0:
+                chunk_size = min(chunk_size, self.buffer_free)
+
+        last_report = time.monotonic()
+        for data, finished in encode_chunks(texts, chunk_size):
+            self._wait(len(data))
+            self.port.write(data)
+            # keep at most one chunk in flight, so an XOFF is never answered
+            # with a backlog the OS has already queued up
+            self.port.flush()
+            if self.line_rate:
+                self.line_free_at = max(time.monotonic(), self.line_free_at) + len(data) / self.line_rate
+            if self.buffer_free is not None:
+                self.buffer_free -= len(data)
+            progress.update(len(data), finished)
+            if self.on_progress and time.monotonic() - last_report >= self.report_interval:
+                self.on_progress(progress)
+                last_report = time.monotonic()
+        self.port.flush()
+        while time.monotonic() < self.line_free_at:
+            self._read_input(self.line_free_at - time.monotonic())
+        progress.finish()
+        if self.on_progress:
+            self.on_progress(progress)
+        return progress
+
+
+class SimulatedPlotter:
+    """
+    A pretend plotter behind a pty: a `buffer_size`-byte buffer drained at
+    `rate` bytes per second, fed over a line carrying `line_rate` bytes per
+    second (38400 baud is about 3840). It sends XOFF when the buffer is `high_water`
+    full and XON once it's down to `low_water`, answers `ESC.B` queries, and
+    counts the bytes it had to drop because the buffer was full. Open
+    `path` as the plotter port.
+    """
+
+    def __init__(self, buffer_size=1024, rate=1000.0, line_rate=3840.0, xonxoff=True, answer_queries=True, high_water=0.75, low_water=0.25):
+        self.buffer_size = buffer_size
+        self.rate = rate
+        self.line_rate = line_rate
+        self.xonxoff = xonxoff
+        self.answer_queries = answer_queries
+        self.high_water = int(buffer_size * high_water)
+        self.low_water = int(buffer_size * low_water)
+        self.received = bytearray()
+        self.overruns = 0
+        self.fill = 0
+        self._partial = b''
+        self._line = bytearray()
+        self.master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.path = os.ttyname(slave)
+        self._slave = slave
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        os.close(self.master)
+        os.close(self._slave)
+
+    def wait_idle(self, timeout=None):
+        """Blocks until everything received so far has been 'plotted'."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while (self.fill or self._line) and (deadline is None or time.monotonic() < deadline):
+            time.sleep(0.01)
+
+    def _accept(self, data: bytes):
+        if self.answer_queries:
+            data = self._partial + data
+            self._partial = b''
+            while BUFFER_QUERY in data:
+                before, _, data = data.partition(BUFFER_QUERY)
+                self._store(before)
+                os.write(self.master, str(self.buffer_size - self.fill).encode('ASCII') + b'\r')
+            # hold back what might be the start of a query split across reads
+            for keep in range(len(BUFFER_QUERY) - 1, 0, -1):
+                if data.endswith(BUFFER_QUERY[:keep]):
+                    data, self._partial = data[:-keep], data[-keep:]
+                    break
+        self._store(data)
+
+    def _store(self, data: bytes):
+        room = self.buffer_size - self.fill
+        self.overruns += max(0, len(data) - room)
+        data = data[:room]
+        self.received += data
+        self.fill += len(data)
+
+    def _run(self):
+        paused = False
+        last = time.monotonic()
+        drained = 0.0
+        # bytes still "on the wire", delivered at line_rate
+        line = self._line
+        credit = 0.0
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self.master], [], [], 0.002)
+            if ready:
+                try:
+                    line += os.read(self.master, 65536)
+                except OSError:
+                    pass
+            now = time.monotonic()
+            credit += (now - last) * self.line_rate
+            drained += (now - last) * self.rate
+            last = now
+            if line:
+                n = min(int(credit), len(line))
+                if n:
+                    self._accept(bytes(line[:n]))
+                    del line[:n]
+                    credit -= n
+            else:
+                credit = 0.0  # an idle line doesn't bank time
+            if drained >= 1:
+                self.fill -= min(self.fill, int(drained))
+                drained -= int(drained)
+            if not self.fill:
+                drained = 0.0
+            if self.xonxoff:
+                if not paused and self.fill >= self.high_water:
+                    os.write(self.master, bytes([XOFF]))
+                    paused = True
+                elif paused and self.fill <= self.low_water:
+                    os.write(self.master, bytes([XON]))
+                    paused = False
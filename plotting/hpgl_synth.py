@@ -0,0 +1,112 @@
+"""
+Synthetic plots that look like CLO3D exports, for benchmarking and for
+trying changes out on something bigger than the plots lying around.
+
+Each piece is a wobbly closed outline with its seam allowance around it.
+The allowance comes in several open blocks, each ended with a bare `PU;`,
+whose ends sometimes miss each other by a unit or two. Some outlines are
+exported twice and some allowance blocks are repeated over part of their
+length, the way overlapping lines come out of CLO3D. Each piece also gets
+a grainline and a few `LB` labels. Everything is drawn with pen 1, like an
+unmarked export.
+"""
+
+import math, random
+from typing import *
+
+# seam allowance width, in plotter units (1 cm)
+ALLOWANCE = 400
+LABEL_TEXTS = ("{name}", "Size {size}", "Cut {count} - Self", "Fabric 1")
+SIZES = ('XS', 'S', 'M', 'L', 'XL')
+
+
+def piece_shape(rng: random.Random) -> List[Tuple[int, float, float]]:
+    """Harmonics (order, amplitude, phase) making a circle wobble like a pattern piece."""
+    return [(k, rng.uniform(0, 0.15 / k), rng.uniform(0, 2 * math.pi)) for k in range(2, 6)]
+
+
+def piece_outline(shape, cx: float, cy: float, radius: float, count: int, offset=0.0) -> List[Tuple[int, int]]:
+    """`count` points round a closed outline of `shape` about `radius`, pushed out by `offset`."""
+    points = []
+    for i in range(count):
+        t = 2 * math.pi * i / count
+        r = radius * (1 + sum(a * math.cos(k * t + phase) for k, a, phase in shape)) + offset
+        points.append((int(round(cx + r * math.cos(t))), int(round(cy + r * math.sin(t)))))
+    return points
+
+
+def path_block(points: Sequence[Tuple[int, int]], pen=1) -> str:
+    return "SP{};\nPU{},{};\nPD{};\nPU;\n".format(pen, points[0][0], points[0][1], ",".join("{},{}".format(x, y) for x, y in points[1:]))
+
+
+def label_block(rng: random.Random, x: float, y: float, text: str) -> str:
+    angle = rng.choice((0, 0, 90, rng.uniform(0, 360)))
+    dx, dy = math.cos(math.radians(angle)), math.sin(math.radians(angle))
+    return "SP1;\nDT$,1;\nPA{},{};\nDI{:.4f},{:.4f};\nSI0.25,0.35;\nLB{}$;\nPU;\n".format(int(x), int(y), dx, dy, text)
+
+
+def synthetic_plot(pieces=20, vertices=20000, labels=3, overlap=0.1, gap=2, seed=0) -> str:
+    """
+    HPGL text of `pieces` pieces adding up to about `vertices` vertices,
+    laid out in rows 1.6 m across. `overlap` is the share of outlines and
+    allowance blocks exported twice, and allowance ends miss each other by
+    up to `gap` plotter units.
+    """
+    rng = random.Random(seed)
+    per_piece = max(vertices // max(pieces, 1), 24)
+    out = ["IN;\n", "IP0,0,40000,40000;\n", "SC0,1,0,1,2;\n", "PU;\n"]
+    roll, x, y, row_height = 64000, 0.0, 0.0, 0.0
+    for p in range(pieces):
+        radius = rng.uniform(2000, 8000)
+        size = 2 * (radius * 1.3 + ALLOWANCE) + 800
+        if y + size > roll:
+            x, y, row_height = x + row_height, 0.0, 0.0
+        cx, cy = x + size / 2, y + size / 2
+        y += size
+        row_height = max(row_height, size)
+
+        shape = piece_shape(rng)
+        outline = piece_outline(shape, cx, cy, radius, per_piece // 2)
+        out.append(path_block(outline + outline[:1]))
+        if rng.random() < overlap:
+            out.append(path_block(outline + outline[:1]))
+
+        allowance = piece_outline(shape, cx, cy, radius, per_piece // 2 - 2, ALLOWANCE)
+        cuts = sorted(rng.sample(range(1, len(allowance)), min(rng.randint(3, 8), len(allowance) - 1)))
+        allowance.append(allowance[0])
+        for start, end in zip([0] + cuts, cuts + [len(allowance) - 1]):
+            segment = allowance[start:end + 1]
+            if gap and rng.random() < 0.3:
+                segment[0] = (segment[0][0] + rng.randint(-gap, gap), segment[0][1] + rng.randint(-gap, gap))
+            out.append(path_block(segment))
+            if rng.random() < overlap and len(segment) > 2:
+                out.append(path_block(segment[:len(segment) // 2 + 1]))
+
+        out.append(path_block([(int(cx), int(cy - radius / 2)), (int(cx), int(cy + radius / 2))]))
+        fields = dict(name="Piece {}".format(p + 1), size=rng.choice(SIZES), count=rng.choice((1, 2)))
+        for i, text in enumerate(LABEL_TEXTS[:labels]):
+            out.append(label_block(rng, cx - radius / 3, cy - i * 600, text.format(**fields)))
+    out.append("SP0;\nIN;\nPG;\n")
+    return "".join(out)
+
+
+def synthetic_font(seed=0) -> str:
+    """A CXF font of scribbles for every printable character, so labels can be rewritten without real fonts installed."""
+    rng = random.Random(seed)
+    lines = ["# Format: QCad 2 Font", "# Name: synthetic", ""]
+    for code in range(33, 127):
+        ch = chr(code)
+        if ch == 'X':
+            commands = ["L 0,0,6,9", "L 0,9,6,0"]
+        else:
+            commands, x, y = [], 0.0, 0.0
+            for i in range(4):
+                nx, ny = round(rng.uniform(0, 6), 4), round(rng.uniform(0, 9), 4)
+                commands.append("L {},{},{},{}".format(x, y, nx, ny))
+                x, y = nx, ny
+            commands.append("A {},{},{},{},{}".format(round(rng.uniform(1, 5), 4), round(rng.uniform(1, 8), 4),
+                                                       round(rng.uniform(0.5, 3), 4), rng.choice((0, 90, 180)), rng.choice((90, 270, 360))))
+        lines.append("[{}] {}".format(ch, len(commands)))
+        lines.extend(commands)
+        lines.append("")
+    return "\n".join(lines) + "\n"
@@ -1,37 +1,109 @@
 import shapely, shapely.geometry, shapely.ops, shapely.affinity
 import cxf_font
-import hpgl
-import os.path
-from shapely.affinity import rotate, scale, translate
+import hpgl, hpgl_profile
+import os, os.path, hashlib
+import numpy as np
 from shapely.geometry import LineString, Point
-from math import atan2
+from math import atan2, ceil, log2, pi
+from collections.abc import Mapping
+from functools import lru_cache
 import glob
 from typing import *
 
-font_stash: Dict[str, Dict[str, Glyph]]
-font_stash = {}
-
 Coord = Tuple[float, float]
 
+FONT_DIR = os.path.expanduser('~/cxf_fonts')
+FONT_CACHE_DIR = os.path.expanduser('~/.cache/stitchware/fonts')
+# bump when the compiled layout changes, to ignore old cache files
+FONT_CACHE_VERSION = 2
+
+# most a tessellated glyph arc may stray from the true one, in plotter units
+ARC_TOLERANCE = 2.0
+# glyph tessellations are shared between scales within a quarter octave
+SCALE_BUCKETS_PER_OCTAVE = 4
+
 def map_glyph(f, strokes: List[LineString]):
     return [f(s) for s in strokes]
 
 def map_glyph_vector(stroke_f, glyphs: List[List[LineString]]):
     return [map_glyph(stroke_f, g) for g in glyphs]
 
+def shift_pieces(pieces: np.ndarray, xoff: float) -> np.ndarray:
+    shifted = pieces.copy()
+    shifted[:, 1] += xoff
+    lines = shifted[:, 0] == cxf_font.LINE
+    shifted[lines, 3] += xoff
+    return shifted
+
+def join_pieces(a: np.ndarray, b: np.ndarray, fuzzy=0.5) -> Optional[np.ndarray]:
+    """`hpgl.extend_line` for strokes made of `cxf_font` pieces."""
+    (a0, a1), (b0, b1) = cxf_font.piece_ends(a), cxf_font.piece_ends(b)
+    if hpgl.dist(a1, b0) <= fuzzy:
+        return np.concatenate((a, b))
+    if hpgl.dist(b1, a0) <= fuzzy:
+        return np.concatenate((b, a))
+    if hpgl.dist(a0, b0) <= fuzzy:
+        return np.concatenate((cxf_font.reverse_pieces(a), b))
+    if hpgl.dist(a1, b1) <= fuzzy:
+        return np.concatenate((a, cxf_font.reverse_pieces(b)))
+    return None
+
 class Glyph:
-    def __init__(self, strokes: List[LineString]):
-        self.strokes = strokes
-        glom = shapely.geometry.MultiLineString(self.strokes)
-        bounds = glom.bounds
-        bounds = [tuple(bounds[:2]), tuple(bounds[2:])]
-        self.width = bounds[1][0] - bounds[0][0]
-        self.height = bounds[1][1] - bounds[0][1]
-        self.strokes = self.mapped(lambda s: translate(s, xoff=-bounds[0][0]))
+    """
+    Strokes of one character, shifted so the glyph starts at x = 0. Each
+    stroke is an array of `cxf_font` line and arc pieces. Arcs are turned
+    into vertices once the scale they're drawn at is known, and kept per
+    scale bucket.
+    """
+    def __init__(self, pieces: List[np.ndarray], size: Optional[Tuple[float, float]] = None):
+        self.pieces = pieces
+        self._tessellated: Dict[int, List[np.ndarray]] = {}
+        self._strokes: Dict[int, List[LineString]] = {}
+        if size is not None:
+            self.width, self.height = size
+            return
+        # metrics come from the historical 20 degree tessellation, so label
+        # layout doesn't shift
+        legacy = [cxf_font.tessellate(p, cxf_font.arc_segments(p)) for p in pieces]
+        glom = np.concatenate(legacy) if legacy else np.zeros((1, 2))
+        mins, maxes = glom.min(axis=0), glom.max(axis=0)
+        self.width = float(maxes[0] - mins[0])
+        self.height = float(maxes[1] - mins[1])
+        self.pieces = [shift_pieces(p, -mins[0]) for p in pieces]
         #self.strokes.append(LineString([Point(0, 0), Point(self.width, 0), Point(self.width, self.height), Point(0, self.height), Point(0, 0)]))
+
+    @staticmethod
+    def scale_bucket(fontscale: Tuple[float, float], tolerance=ARC_TOLERANCE) -> int:
+        magnification = max(abs(fontscale[0]), abs(fontscale[1]), 1e-9) / tolerance
+        return ceil(log2(magnification) * SCALE_BUCKETS_PER_OCTAVE)
+
+    def points(self, fontscale=(1.0, 1.0), tolerance=ARC_TOLERANCE) -> List[np.ndarray]:
+        """
+        Stroke vertices in glyph units, with arcs fine enough to stay within
+        `tolerance` plotter units when drawn at `fontscale`.
+        """
+        bucket = self.scale_bucket(fontscale, tolerance)
+        strokes = self._tessellated.get(bucket)
+        if strokes is None:
+            # radii in tolerances, at the largest magnification in the bucket
+            magnification = 2.0 ** (bucket / SCALE_BUCKETS_PER_OCTAVE)
+            strokes = []
+            for p in self.pieces:
+                radius = np.maximum(p[:, 3] * magnification, 1.0)
+                max_angle = np.minimum(2 * np.arccos(1 - 1 / radius), pi)
+                strokes.append(cxf_font.tessellate(p, cxf_font.arc_segments(p, max_angle)))
+            self._tessellated[bucket] = strokes
+        return strokes
+
+    def strokes_at(self, fontscale=(1.0, 1.0), tolerance=ARC_TOLERANCE) -> List[LineString]:
+        bucket = self.scale_bucket(fontscale, tolerance)
+        strokes = self._strokes.get(bucket)
+        if strokes is None:
+            strokes = self._strokes[bucket] = [LineString(s) for s in self.points(fontscale, tolerance)]
+        return strokes
     
-    def mapped(self, f: Callable) -> List[LineString]:
-        return map_glyph(f, self.strokes)
+    def mapped(self, f: Callable, fontscale=(1.0, 1.0)) -> List[LineString]:
+        return map_glyph(f, self.strokes_at(fontscale))
     
 
 def coords_list_to_points(coords: List[Coord]) -> List[Point]:
@@ -39,76 +111,191 @@ def coords_list_to_points(coords: List[Coord]) -> List[Point]:
 
 
 def load_transformable_font(filename: str):
-    raw_strokes = cxf_font.parse_cxf_font(filename)
+    raw_strokes = cxf_font.parse_cxf_pieces(filename)
     for k in raw_strokes.keys():
-        conjoined = [raw_strokes[k][0]]
+        conjoined = raw_strokes[k][:1]
         for s in raw_strokes[k][1:]:
-            extended = hpgl.extend_line(conjoined[-1], s, fuzzy=0.5)
-            if extended:
+            extended = join_pieces(conjoined[-1], s, fuzzy=0.5)
+            if extended is not None:
                 conjoined[-1] = extended
             else:
                 conjoined.append(s)
-        ls_strokes = [shapely.geometry.LineString(coords_list_to_points(stroke)) for stroke in conjoined]
         
-        raw_strokes[k] = Glyph(ls_strokes)
+        raw_strokes[k] = Glyph(conjoined)
 
     return raw_strokes
 
 
+def font_cache_path(filename: str) -> str:
+    filename = os.path.abspath(filename)
+    digest = hashlib.sha1(filename.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(FONT_CACHE_DIR, os.path.basename(os.path.splitext(filename)[0]) + '-' + digest + '.npz')
+
+
+def save_compiled_font(font: Dict[str, Glyph], filename: str):
+    """Packs a loaded font into one .npz next to the other compiled fonts, keyed on `filename` and its mtime."""
+    keys = list(font.keys())
+    strokes = [s for k in keys for s in font[k].pieces]
+    arrays = dict(
+        version=np.array(FONT_CACHE_VERSION),
+        source=np.array(os.path.abspath(filename)),
+        mtime=np.array(os.stat(filename).st_mtime_ns),
+        keys=np.array(keys, dtype=np.str_),
+        sizes=np.array([[font[k].width, font[k].height] for k in keys], dtype=np.float64).reshape(-1, 2),
+        stroke_counts=np.array([len(font[k].pieces) for k in keys], dtype=np.int64),
+        piece_counts=np.array([len(s) for s in strokes], dtype=np.int64),
+        pieces=np.concatenate(strokes) if strokes else np.empty((0, 6)),
+    )
+    cache_file = font_cache_path(filename)
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    hpgl.write_atomic(cache_file, lambda f: np.savez(f, **arrays))
+
+
+def load_compiled_font(filename: str) -> Optional[Dict[str, Glyph]]:
+    """The cached compile of `filename`, or None if there isn't a current one."""
+    try:
+        with np.load(font_cache_path(filename)) as cached:
+            if int(cached['version']) != FONT_CACHE_VERSION: return None
+            if str(cached['source']) != os.path.abspath(filename): return None
+            if int(cached['mtime']) != os.stat(filename).st_mtime_ns: return None
+            keys, sizes = cached['keys'].tolist(), cached['sizes']
+            stroke_counts, piece_counts, pieces = cached['stroke_counts'], cached['piece_counts'], cached['pieces']
+    except (OSError, KeyError, ValueError):
+        return None
+
+    strokes = np.split(pieces, np.cumsum(piece_counts)[:-1]) if len(piece_counts) else []
+    font = {}
+    first = 0
+    for k, size, count in zip(keys, sizes.tolist(), stroke_counts.tolist()):
+        font[k] = Glyph(strokes[first:first + count], size)
+        first += count
+    return font
+
+
+def load_font(filename: str) -> Dict[str, Glyph]:
+    """Loads a CXF font through the compiled cache, compiling it if it's missing or stale."""
+    font = load_compiled_font(filename)
+    if font is not None: return font
+    font = load_transformable_font(filename)
+    try:
+        save_compiled_font(font, filename)
+    except OSError as ex:
+        print("Cannot cache font: " + filename)
+        print(ex)
+    return font
+
+
+class FontStash(Mapping):
+    """Fonts by name, found by filename and only loaded when first used."""
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._paths: Optional[Dict[str, str]] = None
+        self._fonts: Dict[str, Dict[str, Glyph]] = {}
+
+    @property
+    def paths(self) -> Dict[str, str]:
+        if self._paths is None:
+            self._paths = {os.path.basename(os.path.splitext(ff)[0]): ff for ff in sorted(glob.glob(os.path.join(self.directory, '*.cxf')))}
+        return self._paths
+
+    def __getitem__(self, fontname: str) -> Dict[str, Glyph]:
+        font = self._fonts.get(fontname)
+        if font is None:
+            if fontname not in self.paths: raise KeyError(fontname)
+            print("Loading font: " + fontname)
+            font = self._fonts[fontname] = load_font(self.paths[fontname])
+        return font
+
+    def __setitem__(self, fontname: str, font: Dict[str, Glyph]):
+        self._fonts[fontname] = font
+        # label strokes are cached by font name
+        _label_strokes.cache_clear()
+
+    def __contains__(self, fontname):
+        return fontname in self._fonts or fontname in self.paths
+
+    def __iter__(self):
+        return iter(sorted(set(self.paths) | set(self._fonts)))
+
+    def __len__(self):
+        return len(set(self.paths) | set(self._fonts))
+
+
+font_stash = FontStash(FONT_DIR)
+
+
 def calculate_font_scale(fontname: str, cm_size: Tuple[float, float]) -> Tuple[float, float]:
     glyph_size = font_stash[fontname]['X'].width, font_stash[fontname]['X'].height
     return (cm_size[0] * 400 / glyph_size[0], cm_size[1] * 400 / glyph_size[1])
 
 
-def glyph_string(font, text, t=(0.0, 0.0), r=0.0, fontscale=(1.0, 25.0)):
+def layout_glyphs(font, text) -> Tuple[List[Glyph], np.ndarray]:
+    """The glyphs setting `text`, and where each starts along x in glyph units."""
     kernwidth = font['X'].width * 0.2
-    retval = []
-    x_accum = 0.0
-    for c in text:
-        if c not in font:
-            c = 'X'
-        glyph = font[c]
-        retval.append(glyph.mapped(lambda line: translate(scale(line, xfact=fontscale[0], yfact=fontscale[1], origin=(0, 0)), xoff=x_accum)))
-        x_accum += (glyph.width + kernwidth) * fontscale[0] # kerning like a champ lol
-    
-    retval = map_glyph_vector(lambda s: translate(rotate(s, r, origin=(0, 0), use_radians=True), xoff=t[0], yoff=t[1]), retval)
-    return retval
+    glyphs = [font[c] if c in font else font['X'] for c in text]
+    advances = np.array([0.0] + [g.width + kernwidth for g in glyphs]) # kerning like a champ lol
+    return glyphs, np.cumsum(advances)[:-1]
 
 
-def label_to_traces(text_params: dict, fontname='courier'):
-    dx, dy = text_params['direction']
-    angle = atan2(dy, dx)
+def label_matrix(r=0.0, fontscale=(1.0, 1.0)) -> np.ndarray:
+    """Glyph units to plotter units: scale by `fontscale`, then rotate by `r` radians."""
+    c, s = np.cos(r), np.sin(r)
+    return np.array([[c, -s], [s, c]]) @ np.diag(fontscale)
 
-    fontscale = calculate_font_scale(fontname, text_params['size'])
 
-    glyphs = glyph_string(font_stash[fontname], text_params['text'], t=text_params['origin'], r=angle, fontscale=fontscale)
+def glyph_string_coords(font, text, t=(0.0, 0.0), r=0.0, fontscale=(1.0, 25.0)) -> Tuple[np.ndarray, List[int], List[int]]:
+    """
+    Every stroke of `text` laid out and transformed in one go. Returns the
+    stacked vertices, the row each stroke ends at, and the number of strokes
+    in each character.
+    """
+    glyphs, starts = layout_glyphs(font, text)
+    points = [g.points(fontscale) for g in glyphs]
+    counts = [len(p) for p in points]
+    strokes = [s + (x, 0.0) for p, x in zip(points, starts) for s in p]
+    if not strokes:
+        return np.empty((0, 2)), [], counts
+    coords = np.concatenate(strokes) @ label_matrix(r, fontscale).T + t
+    ends = np.cumsum([len(s) for s in strokes]).tolist()
+    return coords, ends, counts
+
+
+def glyph_string(font, text, t=(0.0, 0.0), r=0.0, fontscale=(1.0, 25.0)) -> List[List[LineString]]:
+    coords, ends, counts = glyph_string_coords(font, text, t, r, fontscale)
+    lines = [LineString(c) for c in np.split(coords, ends[:-1])] if ends else []
     retval = []
-    for g in glyphs:
-        retval.extend([hpgl.line_to_block(stroke, 4) for stroke in g])
+    for n in counts:
+        retval.append(lines[:n])
+        lines = lines[n:]
     return retval
 
 
-def rewrite_first_label(plot: hpgl.HPGLPlot, fontname='courier'):
-    for idx, b in enumerate(plot.blocks[:]):
-        if not b.is_text(): continue
-        print(idx)
-        plot.blocks = plot.blocks[:idx] + label_to_traces(b.get_text_properties(), fontname) + plot.blocks[idx + 1:]
-        return True
-    return False    
+@lru_cache(maxsize=1024)
+def _label_strokes(fontname: str, text: str, size: Tuple[float, float], direction: Tuple[float, float]) -> Tuple[np.ndarray, List[int]]:
+    # relative to the label origin, so repeats of a label anywhere share it
+    fontscale = calculate_font_scale(fontname, size)
+    coords, ends, _ = glyph_string_coords(font_stash[fontname], text, r=atan2(direction[1], direction[0]), fontscale=fontscale)
+    coords.flags.writeable = False
+    return coords, ends
 
-def rewrite_labels(plot: hpgl.HPGLPlot, fontname='courier'):
-    while rewrite_first_label(plot, fontname): pass
 
+def label_to_traces(text_params: dict, fontname='courier') -> List[hpgl.Block]:
+    coords, ends = _label_strokes(fontname, text_params['text'], tuple(text_params['size']), tuple(text_params['direction']))
+    if not ends: return []
+    coords = coords + text_params['origin']
+    return [hpgl.coords_to_block(c, 4) for c in np.split(coords, ends[:-1])]
 
-#font_stash['courier'] = load_transformable_font(os.path.expanduser('~/cxf_fonts/courier.cxf'))
 
-font_files = glob.glob(os.path.expanduser('~/cxf_fonts/*.cxf'))
-for ff in font_files:
-    try:
-        fontname = os.path.basename(os.path.splitext(ff)[0])
-        print("Loading font: " + fontname)
-        font_stash[fontname] = load_transformable_font(ff)
-    except Exception as ex:
-        print("Cannot load: " + ff)
-        print(ex)
-        raise ex
\ No newline at end of file
+@hpgl_profile.timed('labels')
+def rewrite_labels(plot: hpgl.HPGLPlot, fontname='courier') -> int:
+    """Replace every text label with pen 4 strokes, in one pass. Returns how many were rewritten."""
+    blocks, rewritten = [], 0
+    for b in plot.blocks:
+        if not b.is_text():
+            blocks.append(b)
+            continue
+        blocks.extend(label_to_traces(b.get_text_properties(), fontname))
+        rewritten += 1
+    if rewritten:
+        plot.blocks = blocks
+    return rewritten
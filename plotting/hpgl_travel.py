@@ -0,0 +1,451 @@
+"""
+Orders the blocks of a plotter pass to cut down on pen-up travel.
+
+Tours are built nearest-neighbour first, then improved with 2-opt and Or-opt
+moves over short neighbour lists. Open paths may be drawn backwards, and
+closed rings may start from any of their vertices. Blocks drawing anything
+more complicated than a single `PU`/`PD` path keep their direction.
+"""
+
+import math, time, heapq
+from operator import itemgetter
+import numpy as np
+import shapely
+import hpgl, hpgl_profile
+from typing import *
+
+Coord = Tuple[float, float]
+
+FIXED, OPEN, RING = 0, 1, 2
+
+# ring vertices offered to the nearest-neighbour construction; the start
+# vertex is refined against the real neighbours afterwards
+RING_CANDIDATES = 16
+
+
+def pen_up_distance(blocks: Iterable[hpgl.Block], start: Coord = (0.0, 0.0)) -> float:
+    total = 0.0
+    position = start
+    for b in blocks:
+        trace = b.trace_array()
+        if trace is None or not len(trace): continue
+        total += math.hypot(trace[0][0] - position[0], trace[0][1] - position[1])
+        position = (trace[-1][0], trace[-1][1])
+    return total
+
+
+def end_position(blocks: Sequence[hpgl.Block], start: Coord = (0.0, 0.0)) -> Coord:
+    for b in reversed(blocks):
+        trace = b.trace_array()
+        if trace is not None and len(trace):
+            return (trace[-1][0], trace[-1][1])
+    return start
+
+
+class PointGrid:
+    """Uniform grid of (point, payload) pairs for nearest-point searches."""
+
+    def __init__(self, points: np.ndarray, payloads: List[Any], alive: Callable[[Any], bool]):
+        self.alive = alive
+        self.lo = points.min(axis=0) if len(points) else np.zeros(2)
+        span = (points.max(axis=0) - self.lo) if len(points) else np.ones(2)
+        self.cell = max(float(np.sqrt(max(span[0], 1.0) * max(span[1], 1.0) / max(len(points), 1) * 2)), 1e-6)
+        self.size = (int(span[0] // self.cell) + 1, int(span[1] // self.cell) + 1)
+        self.cells: Dict[Tuple[int, int], List[Tuple[float, float, Any]]] = {}
+        keys = ((points - self.lo) // self.cell).astype(int).tolist()
+        for (x, y), (cx, cy), payload in zip(points.tolist(), keys, payloads):
+            self.cells.setdefault((cx, cy), []).append((x, y, payload))
+
+    def _key(self, point: Coord) -> Tuple[int, int]:
+        return (int((point[0] - self.lo[0]) // self.cell), int((point[1] - self.lo[1]) // self.cell))
+
+    def _ring(self, cx: int, cy: int, r: int) -> Iterator[Tuple[int, int]]:
+        """Cells at Chebyshev distance `r` from (cx, cy), clipped to the grid."""
+        if not r:
+            yield (cx, cy)
+            return
+        w, h = self.size
+        xs = range(max(cx - r, 0), min(cx + r, w - 1) + 1)
+        ys = range(max(cy - r + 1, 0), min(cy + r - 1, h - 1) + 1)
+        for y in (cy - r, cy + r):
+            if 0 <= y < h:
+                for x in xs:
+                    yield (x, y)
+        for x in (cx - r, cx + r):
+            if 0 <= x < w:
+                for y in ys:
+                    yield (x, y)
+
+    def nearest(self, point: Coord, k=1) -> List[Tuple[float, Any]]:
+        """Up to `k` (distance, payload) pairs, closest first, of live payloads."""
+        cx, cy = self._key(point)
+        w, h = self.size
+        px, py = point
+        found: List[Tuple[float, Any]] = []
+        # rings closer than this miss the grid entirely
+        min_r = max(0, -cx, cx - w + 1, -cy, cy - h + 1)
+        max_r = max(cx, w - 1 - cx, cy, h - 1 - cy, min_r)
+        for r in range(min_r, max_r + 1):
+            for key in self._ring(cx, cy, r):
+                entries = self.cells.get(key)
+                if not entries: continue
+                live = [e for e in entries if self.alive(e[2])]
+                if len(live) != len(entries):
+                    self.cells[key] = live
+                found.extend((math.hypot(x - px, y - py), payload) for x, y, payload in live)
+            if len(found) >= k:
+                found = heapq.nsmallest(k, found, key=itemgetter(0))
+                # anything unscanned is at least r cells away
+                if found[-1][0] <= r * self.cell:
+                    break
+        return sorted(found, key=itemgetter(0))[:k]
+
+
+class TravelOptimizer:
+    """
+    One pass's blocks, as tour items with an adjustable entry and exit.
+
+    For OPEN items `flip` draws the path backwards. For RING items `start`
+    picks the vertex the ring is entered and left from.
+    """
+
+    def __init__(self, blocks: Sequence[hpgl.Block], start: Coord = (0.0, 0.0), neighbours=8):
+        self.blocks = list(blocks)
+        self.origin = start
+        self.traces = [b.trace_array() for b in self.blocks]
+        self.kind = []
+        for b, trace in zip(self.blocks, self.traces):
+            if trace is None or len(trace) < 2 or not b.is_reorientable():
+                self.kind.append(FIXED)
+            elif b.is_closed() and len(trace) > 2:
+                self.kind.append(RING)
+            else:
+                self.kind.append(OPEN)
+        n = len(self.blocks)
+        self.flip = [False] * n
+        self.start = [0] * n
+        self.entry: List[Coord] = [(0.0, 0.0)] * n
+        self.exit: List[Coord] = [(0.0, 0.0)] * n
+        for i in range(n):
+            self._update_ends(i)
+        self.order = list(range(n))
+        self.pos = list(range(n))
+        self.neighbour_count = neighbours
+        self.neighbours: List[List[int]] = []
+        self.deadline = math.inf
+
+    def _expired(self, step: int) -> bool:
+        return step % 256 == 0 and time.monotonic() >= self.deadline
+
+    def _update_ends(self, i: int):
+        trace = self.traces[i]
+        if trace is None or not len(trace):
+            self.entry[i] = self.exit[i] = self.origin
+            return
+        if self.kind[i] == RING:
+            p = (float(trace[self.start[i]][0]), float(trace[self.start[i]][1]))
+            self.entry[i] = self.exit[i] = p
+            return
+        first = (float(trace[0][0]), float(trace[0][1]))
+        last = (float(trace[-1][0]), float(trace[-1][1]))
+        self.entry[i], self.exit[i] = (last, first) if self.flip[i] else (first, last)
+
+    def _out(self, p: int) -> Coord:
+        return self.exit[self.order[p]] if p >= 0 else self.origin
+
+    def _link(self, a: Optional[Coord], b: Optional[Coord]) -> float:
+        if a is None or b is None: return 0.0
+        return math.hypot(a[0] - b[0], a[1] - b[1])
+
+    def _in(self, p: int) -> Optional[Coord]:
+        return self.entry[self.order[p]] if p < len(self.order) else None
+
+    def cost(self) -> float:
+        return sum(self._link(self._out(p - 1), self._in(p)) for p in range(len(self.order)))
+
+    def construct(self):
+        """Greedy nearest-neighbour tour from the origin."""
+        points, payloads = [], []
+        for i, trace in enumerate(self.traces):
+            if self.kind[i] == RING:
+                vertices = np.unique(np.linspace(0, len(trace) - 2, min(RING_CANDIDATES, len(trace) - 1)).astype(int))
+                points.append(trace[vertices])
+                payloads.extend((i, int(v)) for v in vertices)
+            elif self.kind[i] == OPEN:
+                points.append(trace[[0, -1]])
+                payloads.extend(((i, 0), (i, 1)))
+            elif trace is not None and len(trace):
+                points.append(trace[:1])
+                payloads.append((i, 0))
+        visited = [False] * len(self.blocks)
+        grid = PointGrid(np.concatenate(points) if points else np.empty((0, 2)), payloads, lambda pl: not visited[pl[0]])
+
+        order = []
+        position = self.origin
+        while True:
+            found = grid.nearest(position)
+            if not found: break
+            i, choice = found[0][1]
+            visited[i] = True
+            if self.kind[i] == RING:
+                self.start[i] = choice
+            elif self.kind[i] == OPEN:
+                self.flip[i] = bool(choice)
+            self._update_ends(i)
+            order.append(i)
+            position = self.exit[i]
+        # blocks that draw nothing keep their relative place at the end
+        order.extend(i for i in range(len(self.blocks)) if not visited[i])
+        self.order = order
+        self.pos = [0] * len(order)
+        for p, i in enumerate(order):
+            self.pos[i] = p
+
+    def _build_neighbours(self):
+        """Lists the items whose ends lie closest to each item's ends."""
+        ends, owners = [], []
+        for i in range(len(self.blocks)):
+            for point in {self.entry[i], self.exit[i]}:
+                ends.append(point)
+                owners.append(i)
+        self.neighbours = [[] for _ in self.blocks]
+        if not ends: return
+        ends = np.array(ends, dtype=np.float64)
+        owners = np.array(owners)
+        k = self.neighbour_count + 2
+        tree = shapely.STRtree(shapely.points(ends))
+
+        # grow the search radius only for the ends that haven't found k yet
+        span = np.ptp(ends, axis=0)
+        radius = max(math.sqrt(max(span[0] * span[1], 1.0) * k / len(ends)), 1.0)
+        limit = math.hypot(*span) + 1.0
+        pending = np.arange(len(ends))
+        pairs = []
+        while len(pending):
+            query, hits = tree.query(shapely.points(ends[pending]), predicate='dwithin', distance=radius)
+            counts = np.bincount(query, minlength=len(pending))
+            done = (counts >= k + 1) | (radius >= limit)
+            keep = done[query]
+            pairs.append((pending[query[keep]], hits[keep]))
+            pending = pending[~done]
+            radius *= 2
+
+        query = np.concatenate([q for q, _ in pairs])
+        hits = np.concatenate([h for _, h in pairs])
+        distance = np.hypot(*(ends[query] - ends[hits]).T)
+        ranked = np.lexsort((distance, query))
+        query, hits = query[ranked], hits[ranked]
+        # rank of each hit within its query's run
+        first = np.searchsorted(query, query)
+        keep = (np.arange(len(query)) - first <= k) & (owners[query] != owners[hits])
+        near = [set() for _ in self.blocks]
+        for i, j in zip(owners[query[keep]].tolist(), owners[hits[keep]].tolist()):
+            near[i].add(j)
+        self.neighbours = [list(n) for n in near]
+
+    def _reversible(self, i: int, j: int) -> bool:
+        return all(self.kind[self.order[p]] != FIXED for p in range(i, j + 1))
+
+    def _reverse(self, i: int, j: int):
+        segment = self.order[i:j + 1][::-1]
+        self.order[i:j + 1] = segment
+        for p, item in enumerate(segment, i):
+            self.pos[item] = p
+            if self.kind[item] == OPEN:
+                self.flip[item] = not self.flip[item]
+                self._update_ends(item)
+
+    def two_opt(self) -> bool:
+        improved = False
+        n = len(self.order)
+        for i in range(n):
+            if self._expired(i): break
+            a = self._out(i - 1)
+            b = self._in(i)
+            for m in self.neighbours[self.order[i - 1]] if i else self.neighbours[self.order[i]]:
+                j = self.pos[m]
+                if j < i: continue
+                # reversing order[i..j] joins a to the exit of j, and the
+                # entry of i to whatever followed j
+                c = self.exit[self.order[j]]
+                d = self._in(j + 1)
+                delta = self._link(a, c) + self._link(b, d) - self._link(a, b) - self._link(c, d)
+                if delta < -1e-9 and self._reversible(i, j):
+                    self._reverse(i, j)
+                    improved = True
+                    b = self._in(i)
+        return improved
+
+    def or_opt(self, max_length=3) -> bool:
+        improved = False
+        p = 0
+        while p < len(self.order):
+            if self._expired(p): break
+            moved = False
+            for length in range(1, max_length + 1):
+                if p + length > len(self.order): break
+                first, last = self.order[p], self.order[p + length - 1]
+                before, after = self._out(p - 1), self._in(p + length)
+                seg_in, seg_out = self.entry[first], self.exit[last]
+                gain = self._link(before, seg_in) + self._link(seg_out, after) - self._link(before, after)
+                best = None
+                for m in self.neighbours[first] + self.neighbours[last]:
+                    q = self.pos[m]
+                    if p - 1 <= q < p + length: continue
+                    # insert between q and q + 1, forwards or backwards
+                    x, y = self._out(q), self._in(q + 1)
+                    base = self._link(x, y)
+                    forward = self._link(x, seg_in) + self._link(seg_out, y) - base
+                    backward = self._link(x, seg_out) + self._link(seg_in, y) - base
+                    for cost, rev in ((forward, False), (backward, True)):
+                        if cost - gain < -1e-9 and (best is None or cost < best[0]):
+                            best = (cost, q, rev)
+                if best and (not best[2] or self._reversible(p, p + length - 1)):
+                    _, q, rev = best
+                    segment = self.order[p:p + length]
+                    del self.order[p:p + length]
+                    insert_at = q + 1 if q < p else q + 1 - length
+                    self.order[insert_at:insert_at] = segment
+                    lo, hi = min(p, insert_at), max(p, insert_at) + length
+                    for k in range(lo, hi):
+                        self.pos[self.order[k]] = k
+                    if rev:
+                        self._reverse(insert_at, insert_at + length - 1)
+                    improved = moved = True
+                    break
+            if not moved:
+                p += 1
+        return improved
+
+    def choose_ring_starts(self) -> bool:
+        improved = False
+        for p, i in enumerate(self.order):
+            if self.kind[i] != RING: continue
+            vertices = self.traces[i][:-1]
+            before, after = self._out(p - 1), self._in(p + 1)
+            costs = np.hypot(vertices[:, 0] - before[0], vertices[:, 1] - before[1])
+            if after is not None:
+                costs = costs + np.hypot(vertices[:, 0] - after[0], vertices[:, 1] - after[1])
+            best = int(np.argmin(costs))
+            if costs[best] < costs[self.start[i]] - 1e-9:
+                self.start[i] = best
+                self._update_ends(i)
+                improved = True
+        return improved
+
+    def optimize(self, time_limit=0.75):
+        self.deadline = time.monotonic() + time_limit
+        self.construct()
+        self._build_neighbours()
+        while time.monotonic() < self.deadline:
+            improved = self.two_opt()
+            improved = self.or_opt() or improved
+            improved = self.choose_ring_starts() or improved
+            if not improved: break
+
+    def result(self) -> List[hpgl.Block]:
+        retval = []
+        for i in self.order:
+            b = self.blocks[i]
+            if self.kind[i] == RING and self.start[i]:
+                b = b.reoriented(start=self.start[i])
+            elif self.kind[i] == OPEN and self.flip[i]:
+                b = b.reoriented(reverse=True)
+            retval.append(b)
+        return retval
+
+
+def order_pass(blocks: Sequence[hpgl.Block], start: Coord = (0.0, 0.0), time_limit=0.75) -> List[hpgl.Block]:
+    optimizer = TravelOptimizer(blocks, start)
+    optimizer.optimize(time_limit)
+    return optimizer.result()
+
+
+@hpgl_profile.timed('travel')
+def order_passes(passes: Dict[str, List[hpgl.Block]], time_limit=0.75) -> Dict[str, Tuple[float, float]]:
+    """
+    Reorder the pen, label and knife passes from `HPGLPlot.find_passes()` in
+    place. Labels carry on from wherever the pen pass stopped. Returns the
+    pen-up distance of each pass before and after.
+    """
+    report = {}
+    position = (0.0, 0.0)
+    for name in ('pen', 'labels', 'knife'):
+        if name == 'knife':
+            position = (0.0, 0.0)
+        before = pen_up_distance(passes[name], position)
+        passes[name] = order_pass(passes[name], position, time_limit)
+        report[name] = (before, pen_up_distance(passes[name], position))
+        position = end_position(passes[name], position)
+    return report
+
+
+def trace_length(block: hpgl.Block) -> float:
+    trace = block.trace_array()
+    if trace is None or len(trace) < 2: return 0.0
+    return float(np.hypot(*np.diff(trace, axis=0).T).sum())
+
+
+@hpgl_profile.timed('repeat', blocks=lambda blocks: blocks)
+def repeat_pass(blocks: Sequence[hpgl.Block], count: int, cool_length=0.0) -> List[hpgl.Block]:
+    """
+    Every block of a pass `count` times over, without lifting where possible.
+    Closed paths go round again and open paths go back and forth. Runs of
+    consecutive open paths adding up to `cool_length` plotter units are taken
+    in rounds instead, snaking forwards through the run and back, so each
+    path cools while the rest are cut. Anything else is just repeated.
+    """
+    if count <= 1: return list(blocks)
+    repeated: List[hpgl.Block] = []
+    run: List[hpgl.Block] = []
+    run_length = 0.0
+
+    def flush():
+        visits = []
+        for r in range(count):
+            visits.extend((b, r % 2 == 1) for b in (run[::-1] if r % 2 else run))
+        # back-to-back visits to a block, at the turns, are one serpentine
+        i = 0
+        while i < len(visits):
+            b, backwards = visits[i]
+            j = i + 1
+            while j < len(visits) and visits[j][0] is b:
+                j += 1
+            first = b.reoriented(reverse=True) if backwards else b
+            repeated.append(first.serpentine(j - i) if j - i > 1 else first)
+            i = j
+        run.clear()
+
+    for b in blocks:
+        if b.is_reorientable() and not b.is_closed():
+            run.append(b)
+            run_length += trace_length(b)
+            if run_length >= cool_length:
+                flush()
+                run_length = 0.0
+            continue
+        if run:
+            flush()
+            run_length = 0.0
+        if b.is_closed():
+            o = b.clone()
+            o.repeat_continuous_trace(count)
+            repeated.append(o)
+        else:
+            repeated.extend([b] * count)
+    if run:
+        flush()
+    return repeated
+
+
+def simple_repeat(blocks: Sequence[hpgl.Block], count: int) -> List[hpgl.Block]:
+    """How passes used to be repeated: closed paths go round again, anything else is sent `count` times."""
+    repeated = []
+    for b in blocks:
+        if b.is_closed():
+            o = b.clone()
+            o.repeat_continuous_trace(count)
+            repeated.append(o)
+        else:
+            repeated.extend([b] * count)
+    return repeated
@@ -0,0 +1,43 @@
+import random
+import pytest
+import hpgl, hpgl_synth
+
+
+def marked_plot(pieces: int) -> hpgl.HPGLPlot:
+    plot = hpgl.parse_lines([hpgl_synth.synthetic_plot(pieces=pieces, vertices=pieces * 500, labels=0)])
+    for b in plot.blocks:
+        if b.get_pen() == 1 and b.has_trace() and not b.is_closed():
+            b.set_pen(2)
+    return plot
+
+
+def brute_nearest(plot: hpgl.HPGLPlot, point, max_distance=200):
+    distances = [(b.distance_to_trace(point), b) for b in plot.blocks]
+    distances = [(d, b) for d, b in distances if d and d <= max_distance]
+    if not distances: return set()
+    best = min(d for d, b in distances)
+    return {b for d, b in distances if d == best}
+
+
+# few enough cuts to stay on the index's side lists, and enough to fold them in
+@pytest.mark.parametrize('pieces', [10, 80])
+def test_organize_cuts_keeps_indexes(pieces):
+    plot = marked_plot(pieces)
+    index = plot.spatial_index()
+    endpoints = plot.endpoint_index(3.0)
+    hpgl.organize_cuts(plot, 3.0)
+
+    assert plot.spatial_index() is index
+    assert plot.endpoint_index(3.0) is endpoints
+    assert set(index.all_blocks()) == {b for b in plot.blocks if b.trace_array() is not None and len(b.trace_array())}
+
+    (x0, y0), (x1, y1) = plot.extents()
+    rng = random.Random(0)
+    for i in range(300):
+        point = (rng.uniform(x0, x1), rng.uniform(y0, y1))
+        assert set(index.nearest(point, 200)) == brute_nearest(plot, point)
+
+    fresh = hpgl.EndpointIndex(plot.blocks, 3.0)
+    for b in plot.blocks:
+        if b.get_pen() in (2, 3):
+            assert set(endpoints.neighbours(b)) == set(fresh.neighbours(b))